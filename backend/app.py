@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 import pandas as pd
+import io
 import os
+import re
+import shutil
 import uuid
+import json
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import logging
 from werkzeug.utils import secure_filename
 from pathlib import Path
 import sqlite3
-import shutil
+import tempfile
 import openpyxl
 from typing import Dict, List, Any, Optional
 
@@ -23,16 +33,103 @@ from src.processors.interior_sheet_processor import InteriorSheetProcessor
 from src.processors.electrical_sheet_processor import ElectricalSheetProcessor
 from src.processors.ac_sheet_processor import ACSheetProcessor
 from src.processors.fp_sheet_processor import FPSheetProcessor
+from src.processors.base_sheet_processor import WorksheetValues, connect_database
 from src.config.config_manager import ConfigManager
 from models.config_models import (
-    ProcessorType,
     ConfigUpdateRequest,
     ConfigInquiryResponse,
     ConfigUpdateResponse
 )
 
+# Rust-based calamine parses xlsx much faster than openpyxl; fall back to pandas' default engine
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = None
+
 logging.basicConfig(level=logging.DEBUG)
 
+
+def build_output_workbook(template_filepath: str, output_filepath: str, sheets: Dict[str, Dict[str, Any]],
+                          processors: List[Any], markup_options: List[int],
+                          apply_markup_percent: Optional[float] = None,
+                          progress_queue: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Fill the uploaded BOQ workbook with costs and save it as output_filepath.
+    Runs in a worker process, so it only uses its arguments; progress goes to progress_queue as (stage, percent).
+    """
+    def report(stage: str, percent: int):
+        if progress_queue is not None:
+            progress_queue.put((stage, percent))
+    
+    report('loading', 0)
+    
+    # Read the template in one go and patch it in memory
+    with open(template_filepath, 'rb') as f:
+        template = io.BytesIO(f.read())
+    
+    # Output keeps the template formatting; external workbook links are not needed
+    workbook = openpyxl.load_workbook(template, keep_links=False)
+    
+    items_processed = 0
+    items_failed = 0
+    processing_summary = {}
+    
+    # The session already records which processor handled each sheet
+    processors_by_type = {processor.__class__.__name__: processor for processor in processors}
+    
+    for sheet_number, (sheet_name, sheet_info) in enumerate(sheets.items(), start=1):
+        if sheet_name not in workbook.sheetnames:
+            continue
+        
+        processor = processors_by_type.get(sheet_info.get('processor_type'))
+        if not processor:
+            logging.warning(f"No processor found for sheet: {sheet_name}")
+            continue
+        
+        logging.info(f"Writing costs for sheet: {sheet_name}")
+        
+        sheet_result = processor.process_final_sheet(
+            worksheet=workbook[sheet_name], 
+            sheet_info=sheet_info,
+            markup_options=markup_options,
+            apply_markup_percent=apply_markup_percent
+        )
+        
+        items_processed += sheet_result['items_processed']
+        items_failed += sheet_result['items_failed']
+        processing_summary[sheet_name] = sheet_result
+        report('writing', int(90 * sheet_number / len(sheets)))
+    
+    report('saving', 90)
+    output = io.BytesIO()
+    workbook.save(output)
+    workbook.close()
+    
+    # Single write to a temp file next to the output, then an atomic rename.
+    # The .tmp suffix keeps the in-progress file out of the session cleanup sweep
+    fd, temp_filepath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(output_filepath))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(output.getbuffer())
+        # mkstemp creates the file as 0600; publish it with the usual umask-based permissions.
+        # Reading the umask means setting it, which is safe in this single-threaded worker
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_filepath, 0o666 & ~umask)
+        os.replace(temp_filepath, output_filepath)
+    except Exception:
+        os.remove(temp_filepath)
+        raise
+    
+    return {
+        'items_processed': items_processed,
+        'items_failed': items_failed,
+        'processing_summary': processing_summary
+    }
+
+
 class App:
     """Main BOQ processor with CRUD API for master data management"""
     
@@ -48,8 +145,28 @@ class App:
         os.makedirs(self.data_dir, exist_ok=True)
         self.db_path = str(self.data_dir / 'master_data.db')
         
-        # Session management
-        self.processing_sessions = {}
+        # Session management; request threads share the store, so access goes through the lock.
+        # Kept in least-recently-used order and capped, so abandoned sessions cannot pile up
+        self.processing_sessions: OrderedDict = OrderedDict()
+        self._sessions_lock = threading.RLock()
+        self.max_sessions = 50
+        
+        # Uploads an output build is still reading: path -> number of builds. An evicted session's
+        # upload is kept in _deferred_uploads and deleted only when its last build finishes
+        self._uploads_in_use: Dict[str, int] = {}
+        self._deferred_uploads: Dict[str, Dict[str, Any]] = {}
+        
+        # Background output jobs: job_id -> queue of progress messages.
+        # A finished job is dropped once read, or after job_ttl seconds if nobody reads it
+        self.jobs: Dict[str, queue.Queue] = {}
+        self.job_ttl = 600
+        
+        # Workbook filling is CPU-bound Python, so it runs in worker processes outside the GIL.
+        # Workers are spawned rather than forked: a fork of this threaded server could inherit held locks
+        self._workbook_context = multiprocessing.get_context('spawn')
+        self._workbook_pool_lock = threading.Lock()
+        self.workbook_pool = self._new_workbook_pool()
+        self._progress_manager = None
         
         # Folder setup - all in repo root
         self.upload_folder = str(self.app_root / 'storage' / 'uploads')
@@ -74,6 +191,11 @@ class App:
             ACSheetProcessor(self.db_path, self.markup_rates, configs.ac),
             FPSheetProcessor(self.db_path, self.markup_rates, configs.fp)
         ]
+        self._build_sheet_pattern()
+        
+        # openpyxl picks up lxml automatically for faster workbook parsing and saving
+        if not openpyxl.LXML:
+            logging.warning("lxml is not installed; openpyxl will use the slower standard-library XML backend")
         
         # Initialize database (no Excel sync)
         self._init_database()
@@ -85,7 +207,10 @@ class App:
         """Initialize database with all required tables (no Excel sync)"""
         logging.info(f"Initializing database at {self.db_path}")
         
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_database(self.db_path) as conn:
+            # WAL mode persists in the database file; the other settings are applied by connect_database
+            conn.execute("PRAGMA journal_mode=WAL")
+            
             # Create tables for each processor
             for processor in self.sheet_processors:
                 processor.create_table(conn)
@@ -106,9 +231,9 @@ class App:
         # Check if any table has data
         has_data = False
         for processor in self.sheet_processors:
-            cursor.execute(f"SELECT COUNT(*) FROM {processor.table_name}")
-            count = cursor.fetchone()[0]
-            if count > 0:
+            # Stops at the first row instead of counting the whole table
+            cursor.execute(f"SELECT 1 FROM {processor.table_name} LIMIT 1")
+            if cursor.fetchone() is not None:
                 has_data = True
                 break
         
@@ -129,11 +254,13 @@ class App:
             ('INT005', 'ทำฝ้าเพดานทีบาร์', 320.0, 180.0, 'ตร.ม.')
         ]
         
-        for code, name, mat_cost, lab_cost, unit in interior_samples:
-            cursor.execute(
-                "INSERT OR IGNORE INTO interior_items (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        cursor.executemany(
+            "INSERT OR IGNORE INTO interior_items (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
                 (f"item_{uuid.uuid4().hex[:8]}", code, name, mat_cost, lab_cost, mat_cost + lab_cost, unit)
-            )
+                for code, name, mat_cost, lab_cost, unit in interior_samples
+            ]
+        )
         
         # Sample electrical items
         electrical_samples = [
@@ -144,11 +271,13 @@ class App:
             ('EE005', 'ติดตั้งเบรกเกอร์ 32A', 280.0, 150.0, 'ตัว')
         ]
         
-        for code, name, mat_cost, lab_cost, unit in electrical_samples:
-            cursor.execute(
-                "INSERT OR IGNORE INTO ee_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+        cursor.executemany(
+            "INSERT OR IGNORE INTO ee_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+            [
                 (f"item_{uuid.uuid4().hex[:8]}", code, name, mat_cost, lab_cost, unit)
-            )
+                for code, name, mat_cost, lab_cost, unit in electrical_samples
+            ]
+        )
         
         # Sample AC items
         ac_samples = [
@@ -159,11 +288,13 @@ class App:
             ('AC005', 'ติดตั้งรีโมทแอร์', 150.0, 100.0, 'ตัว')
         ]
         
-        for code, name, mat_cost, lab_cost, unit in ac_samples:
-            cursor.execute(
-                "INSERT OR IGNORE INTO ac_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+        cursor.executemany(
+            "INSERT OR IGNORE INTO ac_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+            [
                 (f"item_{uuid.uuid4().hex[:8]}", code, name, mat_cost, lab_cost, unit)
-            )
+                for code, name, mat_cost, lab_cost, unit in ac_samples
+            ]
+        )
         
         # Sample FP items
         fp_samples = [
@@ -174,21 +305,33 @@ class App:
             ('FP005', 'เซ็นเซอร์ควัน', 450.0, 200.0, 'ตัว')
         ]
         
-        for code, name, mat_cost, lab_cost, unit in fp_samples:
-            cursor.execute(
-                "INSERT OR IGNORE INTO fp_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+        cursor.executemany(
+            "INSERT OR IGNORE INTO fp_items (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
+            [
                 (f"item_{uuid.uuid4().hex[:8]}", code, name, mat_cost, lab_cost, unit)
-            )
+                for code, name, mat_cost, lab_cost, unit in fp_samples
+            ]
+        )
         
         conn.commit()
         logging.info("Sample data added to all tables")
     
+    def _build_sheet_pattern(self):
+        """Compile one regex that finds the processor for a sheet name in a single search"""
+        # Lookaheads anchored at the start keep the processor order as the priority,
+        # so the first processor whose pattern appears anywhere in the name wins
+        alternatives = '|'.join(
+            f"(?=.*?{re.escape(processor.sheet_pattern)})(?P<p{index}>)"
+            for index, processor in enumerate(self.sheet_processors)
+        )
+        self._sheet_pattern = re.compile(f"^(?:{alternatives})", re.IGNORECASE | re.DOTALL)
+    
     def _find_processor_for_sheet(self, sheet_name: str):
         """Find the appropriate processor for a given sheet name"""
-        for processor in self.sheet_processors:
-            if processor.matches_sheet(sheet_name):
-                return processor
-        return None
+        match = self._sheet_pattern.match(sheet_name)
+        if not match:
+            return None
+        return self.sheet_processors[int(match.lastgroup[1:])]
     
     def _find_processor_by_type(self, processor_type: str):
         """Find processor by type name"""
@@ -210,10 +353,79 @@ class App:
     
     def store_processing_session(self, session_id: str, data: Dict[str, Any]):
         """Store processing session data"""
-        self.processing_sessions[session_id] = {
-            'data': data,
-            'created_at': datetime.now()
-        }
+        with self._sessions_lock:
+            self.processing_sessions[session_id] = {
+                'data': data,
+                'created_at': datetime.now()
+            }
+            self.processing_sessions.move_to_end(session_id)
+            
+            evicted = []
+            while len(self.processing_sessions) > self.max_sessions:
+                evicted_id, session = self.processing_sessions.popitem(last=False)
+                original_filepath = session['data'].get('original_filepath')
+                if original_filepath in self._uploads_in_use:
+                    # A running output build still needs the template; it deletes the upload when done
+                    self._deferred_uploads[original_filepath] = session['data']
+                    session = None
+                evicted.append((evicted_id, session))
+        
+        for evicted_id, session in evicted:
+            if session:
+                try:
+                    self._remove_session_upload(session['data'])
+                except OSError as e:
+                    logging.warning(f"Failed to delete upload of evicted session {evicted_id}: {e}")
+            logging.info(f"Evicted least recently used session: {evicted_id}")
+    
+    def get_processing_session(self, session_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return the stored data for a session, or None if it does not exist"""
+        with self._sessions_lock:
+            session = self.processing_sessions.get(session_id)
+            if session:
+                self.processing_sessions.move_to_end(session_id)
+        return session['data'] if session else None
+    
+    def _remove_session_upload(self, session_data: Dict[str, Any]) -> Optional[str]:
+        """Delete a session's uploaded file and its upload folder; returns its path if it was deleted"""
+        original_filepath = session_data.get('original_filepath')
+        if not original_filepath:
+            return None
+        try:
+            os.remove(original_filepath)
+        except FileNotFoundError:
+            return None
+        
+        upload_dir = os.path.dirname(original_filepath)
+        if os.path.abspath(upload_dir) != os.path.abspath(self.upload_folder):
+            try:
+                os.rmdir(upload_dir)
+            except OSError as e:
+                logging.warning(f"Failed to remove upload folder {upload_dir}: {e}")
+        return original_filepath
+    
+    def _hold_upload(self, session_data: Dict[str, Any]):
+        """Keep a session's upload from being deleted by eviction until _release_upload"""
+        original_filepath = session_data['original_filepath']
+        with self._sessions_lock:
+            self._uploads_in_use[original_filepath] = self._uploads_in_use.get(original_filepath, 0) + 1
+    
+    def _release_upload(self, session_data: Dict[str, Any]):
+        """Finish a _hold_upload; deletes the upload if its session was evicted in the meantime"""
+        original_filepath = session_data['original_filepath']
+        with self._sessions_lock:
+            remaining = self._uploads_in_use[original_filepath] - 1
+            if remaining:
+                self._uploads_in_use[original_filepath] = remaining
+                return
+            del self._uploads_in_use[original_filepath]
+            evicted_data = self._deferred_uploads.pop(original_filepath, None)
+        
+        if evicted_data:
+            try:
+                self._remove_session_upload(evicted_data)
+            except OSError as e:
+                logging.warning(f"Failed to delete upload of evicted session: {e}")
     
     def _reload_sheet_processors(self):
         """Reload sheet processors with updated configuration"""
@@ -225,10 +437,181 @@ class App:
                 ACSheetProcessor(self.db_path, self.markup_rates, configs.ac),
                 FPSheetProcessor(self.db_path, self.markup_rates, configs.fp)
             ]
+            self._build_sheet_pattern()
             logging.info("Sheet processors reloaded with updated configuration")
         except Exception as e:
             logging.error(f"Error reloading sheet processors: {e}", exc_info=True)
 
+    def _new_workbook_pool(self) -> ProcessPoolExecutor:
+        """Create the worker pool that builds output workbooks"""
+        return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=self._workbook_context)
+    
+    def _replace_broken_workbook_pool(self, broken_pool: ProcessPoolExecutor):
+        """Swap in a fresh worker pool after a worker died, unless another thread already did"""
+        with self._workbook_pool_lock:
+            if self.workbook_pool is broken_pool:
+                logging.warning("Workbook worker pool is broken; starting a new one")
+                broken_pool.shutdown(wait=False)
+                self.workbook_pool = self._new_workbook_pool()
+    
+    def _progress_queue(self):
+        """Queue a worker process can report progress to; the manager process starts on first use"""
+        with self._workbook_pool_lock:
+            if self._progress_manager is None:
+                self._progress_manager = self._workbook_context.Manager()
+            return self._progress_manager.Queue()
+    
+    def _build_workbook(self, progress: Optional[Any], *args) -> Dict[str, Any]:
+        """Run build_output_workbook in the worker pool, relaying its per-sheet progress to progress"""
+        progress_queue = self._progress_queue() if progress else None
+        pool = self.workbook_pool
+        try:
+            future = pool.submit(build_output_workbook, *args, progress_queue=progress_queue)
+        except BrokenProcessPool:
+            # A worker died after the last job finished; this job can still run on a new pool
+            self._replace_broken_workbook_pool(pool)
+            pool = self.workbook_pool
+            future = pool.submit(build_output_workbook, *args, progress_queue=progress_queue)
+        
+        try:
+            if progress_queue is not None:
+                # Keep draining after the future completes so the last messages are not lost
+                while not future.done() or not progress_queue.empty():
+                    try:
+                        stage, percent = progress_queue.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    progress(stage, percent)
+            return future.result()
+        except BrokenProcessPool:
+            self._replace_broken_workbook_pool(pool)
+            raise
+    
+    def _generate_final_boq(self, session_data: Dict[str, Any], markup_options: List[int],
+                            progress: Optional[Any] = None) -> Dict[str, Any]:
+        """Write calculated costs into a copy of the uploaded BOQ and return the response payload"""
+        filename = f"final_boq_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        output_filepath = os.path.join(self.output_folder, filename)
+        
+        result = self._build_workbook(
+            progress, session_data['original_filepath'], output_filepath,
+            session_data['sheets'], self.sheet_processors, markup_options
+        )
+        items_processed = result['items_processed']
+        items_failed = result['items_failed']
+        processing_summary = result['processing_summary']
+        
+        logging.info(f"Processing complete: {items_processed} items processed, {items_failed} failed")
+        
+        return {
+            'success': True,
+            'filename': filename,
+            'download_url': f'/api/download/{filename}',
+            'items_processed': items_processed,
+            'items_failed': items_failed,
+            'processing_summary': processing_summary
+        }
+    
+    def _apply_markup(self, session_data: Dict[str, Any], markup_percent: float,
+                      progress: Optional[Any] = None) -> Dict[str, Any]:
+        """Write costs with the markup applied directly into a copy of the uploaded BOQ"""
+        original_filepath = session_data['original_filepath']
+        original_name = os.path.splitext(os.path.basename(original_filepath))[0]
+        filename = f"{markup_percent}%_{original_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        output_filepath = os.path.join(self.output_folder, filename)
+        
+        result = self._build_workbook(
+            progress, original_filepath, output_filepath,
+            session_data['sheets'], self.sheet_processors, [], markup_percent
+        )
+        items_processed = result['items_processed']
+        items_failed = result['items_failed']
+        processing_summary = result['processing_summary']
+        
+        logging.info(f"Markup application complete: {markup_percent}% applied to {items_processed} items, {items_failed} failed")
+        
+        return {
+            'success': True,
+            'filename': filename,
+            'download_url': f'/api/download/{filename}',
+            'markup_percent': markup_percent,
+            'items_processed': items_processed,
+            'items_failed': items_failed,
+            'processing_summary': processing_summary
+        }
+    
+    def _start_job(self, target, session_data: Dict[str, Any], *args) -> Dict[str, Any]:
+        """Run an output-generating method on a worker thread and return the job reference"""
+        job_id = str(uuid.uuid4())
+        self.jobs[job_id] = queue.Queue()
+        # Held from now, so the upload survives eviction while the job waits for a thread or worker
+        self._hold_upload(session_data)
+        threading.Thread(target=self._run_job, args=(job_id, target, session_data) + args, daemon=True).start()
+        return {
+            'success': True,
+            'job_id': job_id,
+            'progress_url': f'/api/progress/{job_id}'
+        }
+    
+    def _run_job(self, job_id: str, target, session_data: Dict[str, Any], *args):
+        """Call target on this thread, reporting progress and the result to the job queue"""
+        job_queue = self.jobs[job_id]
+        
+        def report(stage: str, percent: int):
+            job_queue.put({'stage': stage, 'percent': percent})
+        
+        try:
+            result = target(session_data, *args, progress=report)
+            message = {'stage': 'done', 'percent': 100, 'result': result}
+        except Exception as e:
+            logging.error(f"Error in background job {job_id}: {e}", exc_info=True)
+            message = {'stage': 'error', 'percent': 100, 'error': str(e)}
+        finally:
+            # Released before the final message, so a reader never sees the job finished while it holds the upload
+            self._release_upload(session_data)
+        job_queue.put(message)
+        
+        # The result waits for a late progress client, but not for the life of the process
+        expiry = threading.Timer(self.job_ttl, self.jobs.pop, args=(job_id, None))
+        expiry.daemon = True
+        expiry.start()
+
+    def _job_messages(self, job_id: str, job_queue: queue.Queue):
+        """Yield a job's progress messages until it finishes; None is yielded after each idle interval"""
+        try:
+            while True:
+                try:
+                    message = job_queue.get(timeout=120)
+                except queue.Empty:
+                    yield None
+                    continue
+                
+                yield message
+                if message['stage'] in ('done', 'error'):
+                    return
+        finally:
+            # Also runs when the client disconnects and the generator is closed
+            self.jobs.pop(job_id, None)
+    
+    def _stream_job(self, target, *args) -> Response:
+        """Run an output job and stream its progress and result on this response as NDJSON lines"""
+        job_id = self._start_job(target, *args)['job_id']
+        job_queue = self.jobs[job_id]
+        
+        def stream():
+            messages = self._job_messages(job_id, job_queue)
+            try:
+                # First line goes out immediately, then loading / per-sheet writing / saving and the result
+                yield json.dumps({'stage': 'started', 'percent': 0, 'job_id': job_id}) + '\n'
+                for message in messages:
+                    yield json.dumps(message or {'stage': 'keep-alive'}) + '\n'
+            finally:
+                # Runs on GeneratorExit when the client disconnects, even before any message was read
+                messages.close()
+                self.jobs.pop(job_id, None)
+        
+        return Response(stream(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
+
     def setup_routes(self):
         """Setup Flask routes including new CRUD endpoints"""
         
@@ -241,50 +624,72 @@ class App:
                 return jsonify({'success': False, 'error': 'No file uploaded'})
             
             file = request.files['file']
-            filepath = os.path.join(self.upload_folder, secure_filename(file.filename))
+            # Every upload gets its own folder, so sessions for files with the same name never share a path
+            upload_dir = os.path.join(self.upload_folder, uuid.uuid4().hex)
+            os.makedirs(upload_dir)
+            filepath = os.path.join(upload_dir, secure_filename(file.filename))
             file.save(filepath)
             
             try:
-                excel_file = pd.ExcelFile(filepath)
                 session_data = {'sheets': {}, 'original_filepath': filepath}
-                
-                sheets_to_process = excel_file.sheet_names
                 total_items = 0
                 total_matches = 0
                 
-                for sheet_name in sheets_to_process:
-                    processor = self._find_processor_for_sheet(sheet_name)
-                    if not processor:
-                        logging.info(f"No processor found for sheet: {sheet_name} - skipping")
-                        continue
+                # Opened once; every sheet below is parsed from this handle instead of reopening the file.
+                # Section scan only reads values, so stream the workbook once for all sheets
+                with pd.ExcelFile(filepath, engine=EXCEL_READ_ENGINE) as excel_file:
+                    structure_workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=False)
+                    try:
+                        sheets_to_process = excel_file.sheet_names
+                        
+                        for sheet_name in sheets_to_process:
+                            processor = self._find_processor_for_sheet(sheet_name)
+                            if not processor:
+                                logging.info(f"No processor found for sheet: {sheet_name} - skipping")
+                                continue
                     
-                    logging.info(f"Processing BOQ sheet: {sheet_name} with {processor.__class__.__name__}")
+                            logging.info(f"Processing BOQ sheet: {sheet_name} with {processor.__class__.__name__}")
                     
-                    df = pd.read_excel(filepath, sheet_name=sheet_name, header=processor.header_row)
-                    processed_items = processor.process_boq_sheet(df)
+                            try:
+                                # Only parse the columns needed for matching
+                                df = pd.read_excel(excel_file, sheet_name=sheet_name, header=processor.header_row,
+                                                   usecols=processor.boq_usecols)
+                            except ValueError:
+                                # Sheet is narrower than the configured columns
+                                df = pd.read_excel(excel_file, sheet_name=sheet_name, header=processor.header_row)
+                            processed_items = processor.process_boq_sheet(df)
                     
-                    try:
-                        temp_workbook = openpyxl.load_workbook(filepath, data_only=False)
-                        temp_worksheet = temp_workbook[sheet_name]
-                        sections = processor.find_section_structure(temp_worksheet, temp_worksheet.max_row)
-                        temp_workbook.close()
-                        logging.info(f"Pre-calculated {len(sections)} sections for {sheet_name}")
-                    except Exception as e:
-                        logging.warning(f"Could not pre-calculate sections for {sheet_name}: {e}")
-                        sections = {}
+                            try:
+                                sheet_values = WorksheetValues(structure_workbook[sheet_name])
+                                sections = processor.find_section_structure(sheet_values, sheet_values.max_row)
+                                logging.info(f"Pre-calculated {len(sections)} sections for {sheet_name}")
+                            except Exception as e:
+                                logging.warning(f"Could not pre-calculate sections for {sheet_name}: {e}")
+                                sections = {}
                     
-                    session_data['sheets'][sheet_name] = {
-                        'processor_type': processor.__class__.__name__,
-                        'header_row': processor.header_row,
-                        'processed_matches': {item['original_row_index']: item['match'] for item in processed_items},
-                        'row_details': {item['original_row_index']: {'code': item['row_code'], 'name': item['row_name']} for item in processed_items},
-                        'sections': sections,
-                        'total_rows': len(df),
-                        'matched_count': len(processed_items)
-                    }
+                            # Split matches and row details in one pass over the processed items
+                            processed_matches = {}
+                            row_details = {}
+                            for item in processed_items:
+                                row_index = item['original_row_index']
+                                processed_matches[row_index] = item['match']
+                                row_details[row_index] = {'code': item['row_code'], 'name': item['row_name']}
+                    
+                            session_data['sheets'][sheet_name] = {
+                                'processor_type': processor.__class__.__name__,
+                                'header_row': processor.header_row,
+                                'processed_matches': processed_matches,
+                                'row_details': row_details,
+                                'sections': sections,
+                                'quantities': processor.get_quantities(df),
+                                'total_rows': len(df),
+                                'matched_count': len(processed_items)
+                            }
                     
-                    total_items += len(df)
-                    total_matches += len(processed_items)
+                            total_items += len(df)
+                            total_matches += len(processed_items)
+                    finally:
+                        structure_workbook.close()
                 
                 session_id = str(uuid.uuid4())
                 self.store_processing_session(session_id, session_data)
@@ -302,6 +707,8 @@ class App:
                 
             except Exception as e:
                 logging.error(f"Error processing BOQ file: {e}", exc_info=True)
+                # No session was stored, so nothing else would ever delete this upload
+                shutil.rmtree(upload_dir, ignore_errors=True)
                 return jsonify({'success': False, 'error': str(e)})
         
         @self.app.route('/api/generate-final-boq', methods=['POST'])
@@ -310,65 +717,51 @@ class App:
             data = request.get_json()
             session_id = data.get('session_id')
             
-            if not session_id or session_id not in self.processing_sessions:
+            session_data = self.get_processing_session(session_id)
+            if not session_data:
                 return jsonify({'success': False, 'error': 'Invalid session'})
             
-            session_data = self.processing_sessions[session_id]['data']
-            original_filepath = session_data['original_filepath']
             markup_options = data.get('markup_options', [30, 50, 100, 130, 150])
             
+            if data.get('background'):
+                # Return immediately; progress and the result are streamed from /api/progress/<job_id>
+                return jsonify(self._start_job(self._generate_final_boq, session_data, markup_options))
+            
+            if data.get('stream'):
+                # Progress lines and the final result arrive on this response as they happen
+                return self._stream_job(self._generate_final_boq, session_data, markup_options)
+            
+            self._hold_upload(session_data)
             try:
-                filename = f"final_boq_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                output_filepath = os.path.join(self.output_folder, filename)
-                shutil.copy(original_filepath, output_filepath)
-                
-                workbook = openpyxl.load_workbook(output_filepath)
-                data_workbook = openpyxl.load_workbook(original_filepath, data_only=True)
-                
-                items_processed = 0
-                items_failed = 0
-                processing_summary = {}
-                
-                for sheet_name, sheet_info in session_data['sheets'].items():
-                    if sheet_name not in workbook.sheetnames:
-                        continue
-                    
-                    processor = self._find_processor_for_sheet(sheet_name)
-                    if not processor:
-                        logging.warning(f"No processor found for sheet: {sheet_name}")
-                        continue
-                    
-                    logging.info(f"Generating costs for sheet: {sheet_name}")
-                    
-                    sheet_result = processor.process_final_sheet(
-                        worksheet=workbook[sheet_name], 
-                        data_worksheet=data_workbook[sheet_name],
-                        sheet_info=sheet_info,
-                        markup_options=markup_options
-                    )
-                    
-                    items_processed += sheet_result['items_processed']
-                    items_failed += sheet_result['items_failed']
-                    processing_summary[sheet_name] = sheet_result
-                
-                workbook.save(output_filepath)
-                workbook.close()
-                data_workbook.close()
-                
-                logging.info(f"Processing complete: {items_processed} items processed, {items_failed} failed")
-                
-                return jsonify({
-                    'success': True,
-                    'filename': filename,
-                    'download_url': f'/api/download/{filename}',
-                    'items_processed': items_processed,
-                    'items_failed': items_failed,
-                    'processing_summary': processing_summary
-                })
+                return jsonify(self._generate_final_boq(session_data, markup_options))
                 
             except Exception as e:
                 logging.error(f"Error generating final BOQ: {e}", exc_info=True)
                 return jsonify({'success': False, 'error': str(e)})
+            finally:
+                self._release_upload(session_data)
+        
+        @self.app.route('/api/progress/<job_id>')
+        def job_progress_route(job_id):
+            """Stream progress of a background output job as server-sent events"""
+            job_queue = self.jobs.get(job_id)
+            if job_queue is None:
+                return jsonify({'success': False, 'error': 'Invalid job_id'}), 404
+            
+            def stream():
+                messages = self._job_messages(job_id, job_queue)
+                try:
+                    for message in messages:
+                        if message is None:
+                            # Heartbeat keeps proxies from closing an idle connection
+                            yield ": keep-alive\n\n"
+                        else:
+                            yield f"data: {json.dumps(message)}\n\n"
+                finally:
+                    # A disconnected client closes this generator; close the job's messages with it
+                    messages.close()
+            
+            return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
         
         @self.app.route('/api/apply-markup', methods=['POST'])
         def apply_markup_route():
@@ -377,70 +770,30 @@ class App:
             session_id = data.get('session_id')
             markup_percent = data.get('markup_percent')
             
-            if not session_id or session_id not in self.processing_sessions:
+            session_data = self.get_processing_session(session_id)
+            if not session_data:
                 return jsonify({'success': False, 'error': 'Invalid session'})
             
             if markup_percent is None or not isinstance(markup_percent, (int, float)):
                 return jsonify({'success': False, 'error': 'markup_percent must be a valid number'})
             
-            session_data = self.processing_sessions[session_id]['data']
-            original_filepath = session_data['original_filepath']
+            if data.get('background'):
+                # Return immediately; progress and the result are streamed from /api/progress/<job_id>
+                return jsonify(self._start_job(self._apply_markup, session_data, markup_percent))
             
+            if data.get('stream'):
+                # Progress lines and the final result arrive on this response as they happen
+                return self._stream_job(self._apply_markup, session_data, markup_percent)
+            
+            self._hold_upload(session_data)
             try:
-                original_name = os.path.splitext(os.path.basename(original_filepath))[0]
-                filename = f"{markup_percent}%_{original_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                output_filepath = os.path.join(self.output_folder, filename)
-                shutil.copy(original_filepath, output_filepath)
-                
-                workbook = openpyxl.load_workbook(output_filepath)
-                data_workbook = openpyxl.load_workbook(original_filepath, data_only=True)
-                
-                items_processed = 0
-                items_failed = 0
-                processing_summary = {}
-                
-                for sheet_name, sheet_info in session_data['sheets'].items():
-                    if sheet_name not in workbook.sheetnames:
-                        continue
-                    
-                    processor = self._find_processor_for_sheet(sheet_name)
-                    if not processor:
-                        logging.warning(f"No processor found for sheet: {sheet_name}")
-                        continue
-                    
-                    logging.info(f"Applying {markup_percent}% markup to sheet: {sheet_name}")
-                    
-                    sheet_result = processor.process_final_sheet(
-                        worksheet=workbook[sheet_name], 
-                        data_worksheet=data_workbook[sheet_name],
-                        sheet_info=sheet_info,
-                        markup_options=[],
-                        apply_markup_percent=markup_percent
-                    )
-                    
-                    items_processed += sheet_result['items_processed']
-                    items_failed += sheet_result['items_failed']
-                    processing_summary[sheet_name] = sheet_result
-                
-                workbook.save(output_filepath)
-                workbook.close()
-                data_workbook.close()
-                
-                logging.info(f"Markup application complete: {markup_percent}% applied to {items_processed} items, {items_failed} failed")
-                
-                return jsonify({
-                    'success': True,
-                    'filename': filename,
-                    'download_url': f'/api/download/{filename}',
-                    'markup_percent': markup_percent,
-                    'items_processed': items_processed,
-                    'items_failed': items_failed,
-                    'processing_summary': processing_summary
-                })
+                return jsonify(self._apply_markup(session_data, markup_percent))
                 
             except Exception as e:
                 logging.error(f"Error applying markup: {e}", exc_info=True)
                 return jsonify({'success': False, 'error': str(e)})
+            finally:
+                self._release_upload(session_data)
         
         @self.app.route('/api/cleanup-session', methods=['POST'])
         def cleanup_session_route():
@@ -455,33 +808,40 @@ class App:
             errors = []
             
             try:
-                if session_id in self.processing_sessions:
-                    session_data = self.processing_sessions[session_id]['data']
-                    original_filepath = session_data.get('original_filepath')
-                    
-                    if original_filepath and os.path.exists(original_filepath):
-                        try:
-                            os.remove(original_filepath)
+                # Take the session out of the store first so it is dropped even if file cleanup fails
+                with self._sessions_lock:
+                    session = self.processing_sessions.pop(session_id, None)
+                
+                if session:
+                    try:
+                        original_filepath = self._remove_session_upload(session['data'])
+                        if original_filepath:
                             files_deleted.append(original_filepath)
                             logging.info(f"Deleted original file: {original_filepath}")
-                        except Exception as e:
-                            errors.append(f"Failed to delete {original_filepath}: {e}")
+                    except Exception as e:
+                        errors.append(f"Failed to delete {session['data'].get('original_filepath')}: {e}")
                     
-                    del self.processing_sessions[session_id]
                     logging.info(f"Cleaned up session: {session_id}")
                 else:
                     return jsonify({'success': False, 'error': 'Invalid session_id'})
                 
-                if os.path.exists(self.output_folder):
-                    for output_file in os.listdir(self.output_folder):
-                        output_path = os.path.join(self.output_folder, output_file)
-                        if os.path.isfile(output_path):
-                            try:
-                                os.remove(output_path)
-                                files_deleted.append(output_path)
-                                logging.info(f"Deleted output file: {output_path}")
-                            except Exception as e:
-                                errors.append(f"Failed to delete {output_path}: {e}")
+                # Remove directly instead of checking first; a file already gone is not an error
+                try:
+                    output_entries = list(os.scandir(self.output_folder))
+                except FileNotFoundError:
+                    output_entries = []
+                
+                for entry in output_entries:
+                    # Skip .tmp files: those are outputs still being written by another request
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        try:
+                            os.remove(entry.path)
+                            files_deleted.append(entry.path)
+                            logging.info(f"Deleted output file: {entry.path}")
+                        except FileNotFoundError:
+                            continue
+                        except Exception as e:
+                            errors.append(f"Failed to delete {entry.path}: {e}")
                 
                 return jsonify({
                     'success': True,
@@ -505,11 +865,12 @@ class App:
                 if not processor:
                     return jsonify({'success': False, 'error': f'Invalid processor type: {processor_type}'})
                 
-                with sqlite3.connect(self.db_path) as conn:
-                    conn.row_factory = sqlite3.Row
+                with connect_database(self.db_path) as conn:
                     cursor = conn.cursor()
                     cursor.execute(f"SELECT * FROM {processor.table_name} ORDER BY code, name")
-                    items = [dict(row) for row in cursor.fetchall()]
+                    # Plain tuples zipped with the column names, no sqlite3.Row per item
+                    columns = [description[0] for description in cursor.description]
+                    items = [dict(zip(columns, row)) for row in cursor.fetchall()]
                 
                 return jsonify({
                     'success': True,
@@ -531,7 +892,7 @@ class App:
                 if not processor:
                     return jsonify({'success': False, 'error': f'Invalid processor type: {processor_type}'})
                 
-                with sqlite3.connect(self.db_path) as conn:
+                with connect_database(self.db_path) as conn:
                     conn.row_factory = sqlite3.Row
                     cursor = conn.cursor()
                     cursor.execute(f"SELECT * FROM {processor.table_name} WHERE internal_id = ?", (item_id,))
@@ -566,7 +927,7 @@ class App:
                 if not data.get('name'):
                     return jsonify({'success': False, 'error': 'Name is required'})
                 
-                with sqlite3.connect(self.db_path) as conn:
+                with connect_database(self.db_path) as conn:
                     cursor = conn.cursor()
                     
                     if processor_type == 'interior':
@@ -596,6 +957,7 @@ class App:
                         )
                     
                     conn.commit()
+                processor.invalidate_match_candidates()
                 
                 return jsonify({
                     'success': True,
@@ -621,7 +983,7 @@ class App:
                 if not data.get('name'):
                     return jsonify({'success': False, 'error': 'Name is required'})
                 
-                with sqlite3.connect(self.db_path) as conn:
+                with connect_database(self.db_path) as conn:
                     cursor = conn.cursor()
                     
                     # Check if item exists
@@ -657,6 +1019,7 @@ class App:
                         )
                     
                     conn.commit()
+                processor.invalidate_match_candidates()
                 
                 return jsonify({
                     'success': True,
@@ -675,7 +1038,7 @@ class App:
                 if not processor:
                     return jsonify({'success': False, 'error': f'Invalid processor type: {processor_type}'})
                 
-                with sqlite3.connect(self.db_path) as conn:
+                with connect_database(self.db_path) as conn:
                     cursor = conn.cursor()
                     
                     # Check if item exists
@@ -686,6 +1049,7 @@ class App:
                     # Delete the item
                     cursor.execute(f"DELETE FROM {processor.table_name} WHERE internal_id = ?", (item_id,))
                     conn.commit()
+                processor.invalidate_match_candidates()
                 
                 return jsonify({
                     'success': True,
@@ -711,53 +1075,59 @@ class App:
                 filepath = os.path.join(self.upload_folder, secure_filename(file.filename))
                 file.save(filepath)
                 
-                # Read Excel file
-                df = pd.read_excel(filepath, header=0)
+                # Read Excel file, keeping only the columns the import uses
+                import_columns = {'code', 'name', 'material_unit_cost', 'labor_unit_cost', 'unit'}
+                df = pd.read_excel(filepath, header=0, usecols=lambda column: column in import_columns,
+                                   engine=EXCEL_READ_ENGINE)
                 
-                imported_count = 0
                 errors = []
                 
-                with sqlite3.connect(self.db_path) as conn:
-                    cursor = conn.cursor()
-                    
-                    for idx, row in df.iterrows():
-                        try:
-                            internal_id = f"import_{uuid.uuid4().hex[:8]}"
-                            
-                            if processor_type == 'interior':
-                                mat_cost = float(row.get('material_unit_cost', 0))
-                                lab_cost = float(row.get('labor_unit_cost', 0))
-                                cursor.execute(
-                                    f"INSERT INTO {processor.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                                    (
-                                        internal_id,
-                                        str(row.get('code', '')),
-                                        str(row.get('name', '')),
-                                        mat_cost,
-                                        lab_cost,
-                                        mat_cost + lab_cost,
-                                        str(row.get('unit', ''))
-                                    )
-                                )
-                            else:
-                                cursor.execute(
-                                    f"INSERT INTO {processor.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)",
-                                    (
-                                        internal_id,
-                                        str(row.get('code', '')),
-                                        str(row.get('name', '')),
-                                        float(row.get('material_unit_cost', 0)),
-                                        float(row.get('labor_unit_cost', 0)),
-                                        str(row.get('unit', ''))
-                                    )
-                                )
-                            
-                            imported_count += 1
-                            
-                        except Exception as e:
-                            errors.append(f"Row {idx + 2}: {str(e)}")
-                    
+                # Missing columns get the same defaults a missing key used to get
+                for column, default in (('code', ''), ('name', ''), ('material_unit_cost', 0), ('labor_unit_cost', 0), ('unit', '')):
+                    if column not in df.columns:
+                        df[column] = default
+                
+                # Convert rows in Python first, so a bad value only rejects its own row;
+                # plain tuples keep each column's own dtype and skip building a Series per row
+                rows = []
+                row_numbers = []
+                internal_ids = processor.generate_item_ids(len(df), 'import')
+                import_rows = df[['code', 'name', 'material_unit_cost', 'labor_unit_cost', 'unit']].itertuples(name=None)
+                for internal_id, (idx, code, name, material_cost, labor_cost, unit) in zip(internal_ids, import_rows):
+                    try:
+                        mat_cost = float(material_cost)
+                        lab_cost = float(labor_cost)
+                        values = (internal_id, str(code), str(name), mat_cost, lab_cost)
+                        if processor_type == 'interior':
+                            values += (mat_cost + lab_cost,)
+                        rows.append(values + (str(unit),))
+                        row_numbers.append(idx + 2)
+                        
+                    except Exception as e:
+                        errors.append(f"Row {idx + 2}: {str(e)}")
+                
+                if processor_type == 'interior':
+                    insert_sql = f"INSERT INTO {processor.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?, ?)"
+                else:
+                    insert_sql = f"INSERT INTO {processor.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) VALUES (?, ?, ?, ?, ?, ?)"
+                
+                # One batched statement in one transaction
+                with connect_database(self.db_path) as conn:
+                    try:
+                        conn.executemany(insert_sql, rows)
+                        imported_count = len(rows)
+                    except sqlite3.IntegrityError:
+                        # One conflicting row fails the whole batch; insert row by row so only it is rejected
+                        conn.rollback()
+                        imported_count = 0
+                        for row_number, values in zip(row_numbers, rows):
+                            try:
+                                conn.execute(insert_sql, values)
+                                imported_count += 1
+                            except sqlite3.Error as e:
+                                errors.append(f"Row {row_number}: {str(e)}")
                     conn.commit()
+                processor.invalidate_match_candidates()
                 
                 # Clean up uploaded file
                 os.remove(filepath)
@@ -781,7 +1151,7 @@ class App:
                 if not processor:
                     return jsonify({'success': False, 'error': f'Invalid processor type: {processor_type}'})
                 
-                with sqlite3.connect(self.db_path) as conn:
+                with connect_database(self.db_path) as conn:
                     df = pd.read_sql_query(f"SELECT * FROM {processor.table_name}", conn)
                 
                 if df.empty:
@@ -863,7 +1233,8 @@ class App:
             """Download generated BOQ file"""
             filepath = os.path.join(self.output_folder, filename)
             if os.path.exists(filepath):
-                return send_file(filepath, as_attachment=True)
+                # Range/If-None-Match support lets large downloads resume and revalidate cheaply
+                return send_file(filepath, as_attachment=True, conditional=True, etag=True, max_age=0)
             return jsonify({'error': 'File not found'}), 404
     
     def run(self, host: str = 'localhost', port: int = 5000, debug: bool = True):
@@ -2,7 +2,7 @@
 BOQ Sheet Processors Package
 """
 
-from .base_sheet_processor import BaseSheetProcessor
+from .base_sheet_processor import BaseSheetProcessor, WorksheetValues, connect_database
 from .interior_sheet_processor import InteriorSheetProcessor
 from .electrical_sheet_processor import ElectricalSheetProcessor
 from .ac_sheet_processor import ACSheetProcessor
@@ -10,6 +10,8 @@ from .fp_sheet_processor import FPSheetProcessor
 
 __all__ = [
     'BaseSheetProcessor',
+    'WorksheetValues',
+    'connect_database',
     'InteriorSheetProcessor', 
     'ElectricalSheetProcessor',
     'ACSheetProcessor',
@@ -6,20 +6,94 @@ This provides common functionality and structure for specific sheet implementati
 
 
 import pandas as pd
+import os
+import re
 import sqlite3
 import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Optional, List
-from fuzzywuzzy import fuzz
+from types import SimpleNamespace
+from typing import Dict, Any, Optional, List, Tuple
+import numpy as np
+from rapidfuzz import fuzz, process
+
+
+def connect_database(db_path: str) -> sqlite3.Connection:
+    """Open the master database with the per-connection settings all callers share"""
+    conn = sqlite3.connect(db_path)
+    # WAL mode is stored in the database file; these settings only last for this connection
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+class WorksheetValues:
+    """
+    In-memory snapshot of a worksheet's cell values.
+    Lets a read-only (streaming) worksheet be scanned with random cell(row, column) access.
+    """
+    
+    def __init__(self, worksheet):
+        self.title = worksheet.title
+        # Read-only iteration stops at the file's <dimension> tag, which some writers leave wrong or stale
+        worksheet.reset_dimensions()
+        self.rows = [tuple(row) for row in worksheet.iter_rows(values_only=True)]
+        self.max_row = len(self.rows)
+    
+    def cell(self, row: int, column: int) -> SimpleNamespace:
+        """Get the cell at 1-based (row, column); missing cells have value None"""
+        value = None
+        if 1 <= row <= self.max_row and 1 <= column <= len(self.rows[row - 1]):
+            value = self.rows[row - 1][column - 1]
+        return SimpleNamespace(value=value)
+    
+    def iter_rows(self, min_row: int = 1, max_row: Optional[int] = None, min_col: int = 1,
+                  max_col: Optional[int] = None, values_only: bool = True):
+        """Yield value tuples for a block of cells (up to the last snapshot row), padded with None like openpyxl's iter_rows"""
+        max_row = self.max_row if max_row is None else min(max_row, self.max_row)
+        for row in self.rows[min_row - 1:max_row]:
+            width = len(row) if max_col is None else max_col
+            values = row[min_col - 1:width]
+            yield values + (None,) * (width - min_col + 1 - len(values))
+
 
 class BaseSheetProcessor(ABC):
     """Abstract base class for sheet processors"""
     
+    # Lowest raw fuzz.ratio that rounds to the 80% needed for a match without a code match
+    NAME_SIMILARITY_CUTOFF = 79.5
+    
+    # Total/summary rows in master sheets ('subtotal' is covered by 'total'); matched
+    # case-insensitively so the column does not need lowering first
+    TOTAL_ROW_PATTERN = re.compile(r'total|sum|รวม', re.IGNORECASE)
+    
+    # Total rows in BOQ sheets; matched against lowered names
+    BOQ_TOTAL_ROW_PATTERN = re.compile(r'total|รวม')
+    
+    # Section total rows in system (EE/AC/FP) sheets: any 'รวมรายการ' label, or a stripped cell that is exactly 'รวม'
+    SECTION_TOTAL_PATTERN = re.compile(r'รวมรายการ|\Aรวม\Z')
+    
+    # Leave item rows with a zero total cost untouched instead of writing zeros over the template.
+    # Off by default: the output then shows blanks, not 0, for unpriced items
+    SKIP_ZERO_COST_WRITES = False
+    
+    # Cost types written to each matched item row; set by each processor
+    ITEM_COST_TYPES: Tuple[str, ...] = ()
+    
     def __init__(self, db_path: str, markup_rates: Dict[int, float], config: Optional[Any] = None):
         self.db_path = db_path
         self.markup_rates = markup_rates
         self.config = config
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Master items prepared for matching, kept until the master table changes
+        self._match_candidates: Optional[SimpleNamespace] = None
+        # (cost_type, column) pairs for item rows, resolved from column_mapping on first write
+        self._item_cost_columns: Optional[List[Tuple[str, int]]] = None
+        
+    def __getstate__(self) -> Dict[str, Any]:
+        """Leave the match candidate cache behind when a processor is sent to a worker process"""
+        state = self.__dict__.copy()
+        state['_match_candidates'] = None
+        return state
         
     @property
     @abstractmethod
@@ -45,6 +119,11 @@ class BaseSheetProcessor(ABC):
         """Database table name for this sheet type"""
         pass
     
+    @property
+    def boq_usecols(self) -> List[int]:
+        """0-based columns to read from a BOQ sheet (contiguous so positional lookups stay valid)"""
+        return list(range(max(self.column_mapping[key] for key in ('code', 'name', 'quantity'))))
+    
     def matches_sheet(self, sheet_name: str) -> bool:
         """Check if this processor handles the given sheet name"""
         return self.sheet_pattern.lower() in sheet_name.lower()
@@ -56,52 +135,59 @@ class BaseSheetProcessor(ABC):
         if df.empty:
             return pd.DataFrame()
         
-        result_data = []
-        processed_items = {}
+        items = self.extract_items_data(df)
+        if items.empty:
+            return pd.DataFrame()
         
-        for idx, row in df.iterrows():
-            try:
-                item_data = self.extract_item_data(row)
-                if not item_data:
-                    continue
-                
-                # Handle duplicates
-                item_key = f"{item_data['code']}|{item_data['name']}"
-                if item_key in processed_items:
-                    self.handle_duplicate_item(processed_items[item_key], item_data)
-                    continue
-                
-                processed_items[item_key] = item_data
-                result_data.append(item_data)
-                
-            except Exception as e:
-                self.logger.error(f"Error processing row {idx}: {e}")
-                continue
+        # Handle duplicates: keep the first occurrence of each (code, name) pair.
+        # The pairs are hashed as a MultiIndex, without building joined key strings
+        item_keys = pd.MultiIndex.from_arrays([items['code'], items['name']])
+        duplicated = pd.Series(item_keys.duplicated(), index=items.index)
+        duplicate_count = int(duplicated.sum())
+        if duplicate_count:
+            # One summary line; the individual pairs only at debug level
+            self.logger.warning(f"Found {duplicate_count} duplicate items in {self.table_name}, keeping the first of each")
+            for code, name in items.loc[duplicated, ['code', 'name']].itertuples(index=False):
+                self.logger.debug("Duplicate item: Code='%s', Name='%s'", code, name)
         
-        if not result_data:
-            return pd.DataFrame()
+        result_df = items[~duplicated].set_index(item_keys[~duplicated])
         
-        result_df = pd.DataFrame(result_data)
-        self.logger.debug(f"Processed {len(result_df)} items from {self.table_name}")
+        # Take costs from the first duplicate that has them if the kept item has none
+        cost_columns = list(items.select_dtypes('number').columns)
+        has_costs = (items[cost_columns] > 0).any(axis=1)
+        donors = items[duplicated & has_costs].set_index(item_keys[duplicated & has_costs])
+        donors = donors[~donors.index.duplicated()]
+        missing_costs = result_df.index[(result_df[cost_columns] == 0).all(axis=1)]
+        fill_keys = missing_costs.intersection(donors.index)
+        if len(fill_keys):
+            result_df.loc[fill_keys, cost_columns] = donors.loc[fill_keys, cost_columns]
+            self.logger.debug("Updated costs for %s duplicate items", len(fill_keys))
+        
+        result_df = result_df.reset_index(drop=True)
+        self.logger.debug("Processed %s items from %s", len(result_df), self.table_name)
         return result_df
     
-   
-    
-   
-    
-    def _safe_float_conversion(self, value: Any) -> float:
-        """Safely convert value to float"""
-        try:
-            return float(value) if pd.notna(value) else 0
-        except (ValueError, TypeError):
-            return 0
-    
-    def _is_skip_row(self, code: str) -> bool:
-        """Check if row should be skipped"""
-        return any(keyword in code.lower() for keyword in ['total', 'รวม', 'sum', 'subtotal'])
+    def generate_item_ids(self, count: int, prefix: str = 'item') -> List[str]:
+        """Random ids like 'item_1a2b3c4d' for count items, drawn from a single os.urandom call"""
+        random_bytes = os.urandom(4 * count)
+        return [f"{prefix}_{random_bytes[start:start + 4].hex()}" for start in range(0, 4 * count, 4)]
     
+    def _text_column(self, df: pd.DataFrame, col_idx: Optional[int]) -> pd.Series:
+        """Get a column as strings exactly as they appear in Excel, with '' for empty cells"""
+        if col_idx is None or col_idx >= df.shape[1]:
+            return pd.Series('', index=df.index)
+        column = df.iloc[:, col_idx]
+        return column.where(column.notna(), '').astype(str)
     
+    def _numeric_column(self, df: pd.DataFrame, col_idx: int) -> pd.Series:
+        """Get a column as floats, with 0 for empty or non-numeric cells"""
+        if col_idx >= df.shape[1]:
+            return pd.Series(0.0, index=df.index)
+        return pd.to_numeric(df.iloc[:, col_idx], errors='coerce').fillna(0.0).astype(float)
     
+    def _skip_row_mask(self, codes: pd.Series) -> pd.Series:
+        """Mark rows that should be skipped (total/summary rows)"""
+        return codes.str.contains(self.TOTAL_ROW_PATTERN)
     
     def _normalize_text(self, text: str) -> str:
         """Normalize text by handling special characters and quotes"""
@@ -129,84 +215,157 @@ class BaseSheetProcessor(ABC):
         
         return normalized.lower()
 
-    def find_best_match(self, name: str, code: str) -> Optional[Dict[str, Any]]:
-        """Find best matching item from database using comprehensive fuzzy matching"""
-        if not name or pd.isna(name):
-            return None
-
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            all_items = conn.execute(f"SELECT * FROM {self.table_name}").fetchall()
+    def load_match_candidates(self) -> SimpleNamespace:
+        """Get master items for matching, reading the database only when nothing is cached"""
+        if self._match_candidates is None:
+            self._match_candidates = self._read_match_candidates()
+        return self._match_candidates
+    
+    def invalidate_match_candidates(self) -> None:
+        """Drop the cached match candidates after the master table has changed"""
+        self._match_candidates = None
+    
+    def _read_match_candidates(self) -> SimpleNamespace:
+        """Load all master items once, column by column, with code and name already normalized"""
+        with connect_database(self.db_path) as conn:
+            cursor = conn.execute(f"SELECT * FROM {self.table_name}")
+            column_names = [description[0] for description in cursor.description]
+            all_items = cursor.fetchall()
+        
+        # One tuple per column; an item dict is only built for rows that win a match
+        columns = dict(zip(column_names, zip(*all_items))) if all_items else {name: () for name in column_names}
+        codes = [self._normalize_text(code) for code in columns['code']]
+        names = [self._normalize_text(name) for name in columns['name']]
+        
+        # First item for each (code, name) pair, for exact matches without fuzzy scoring,
+        # and all items for each code, so code matches are lookups instead of a full comparison
+        exact_index = {}
+        code_index = {}
+        for index, key in enumerate(zip(codes, names)):
+            exact_index.setdefault(key, index)
+            code_index.setdefault(key[0], []).append(index)
+        
+        return SimpleNamespace(
+            columns=columns,
+            names=np.array(names, dtype=str),
+            exact_index=exact_index,
+            code_index=code_index
+        )
+
+    def _candidate_item(self, candidates: SimpleNamespace, index: int) -> Dict[str, Any]:
+        """Build the master item dict for one candidate"""
+        return {column: values[index] for column, values in candidates.columns.items()}
+
+    def find_best_matches(self, names: List[str], codes: List[str], candidates: Optional[SimpleNamespace] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Find best matching items for many BOQ rows at once.
+        Name similarity is scored for every (row, item) pair in a single RapidFuzz call,
+        then the code matching rules are applied to the whole score matrix.
+        """
+        if candidates is None:
+            candidates = self.load_match_candidates()
 
-        if not all_items:
+        if not candidates.names.size:
             self.logger.warning(f"No items found in {self.table_name} database")
-            return None
-
-        sanitized_search = self._normalize_text(name)
-        sanitized_code = self._normalize_text(code) if code and not pd.isna(code) else ""
-
+            return [None] * len(names)
+
+        if not names:
+            return []
+
+        item_names = candidates.names
+
+        # BOQ sheets repeat names and codes a lot, so each distinct value is normalized once
+        normalized_names = {name: self._normalize_text(name) for name in set(names)}
+        normalized_codes = {code: self._normalize_text(code) if code and not pd.isna(code) else "" for code in set(codes)}
+        sanitized_search = np.array([normalized_names[name] for name in names], dtype=str)
+        sanitized_codes = np.array([normalized_codes[code] for code in codes], dtype=str)
+
+        # Each winning item's dict is built once and shared by every row it matches (read-only)
+        item_dicts = {}
+        def item_at(index: int) -> Dict[str, Any]:
+            if index not in item_dicts:
+                item_dicts[index] = self._candidate_item(candidates, index)
+            return item_dicts[index]
+
+        # Case 1: Exact match (code + name) is a dictionary lookup, no fuzzy scoring needed
+        # Hyphen-only names go through the matrix so a code match can still score 95
+        results = [None] * len(names)
+        fuzzy_rows = []
+        for row, (search_code, search_name) in enumerate(zip(sanitized_codes.tolist(), sanitized_search.tolist())):
+            best = candidates.exact_index.get((search_code, search_name)) if search_code and search_name != '-' else None
+            if best is not None:
+                results[row] = {'item': item_at(best), 'similarity': 100}
+            else:
+                fuzzy_rows.append(row)
+
+        if not fuzzy_rows:
+            return results
+
+        # Repeated (code, name) pairs are scored once and the result reused for every copy
+        pair_positions = {}
+        fuzzy_pairs = []
+        unique_rows = []
+        for row in fuzzy_rows:
+            pair = (sanitized_codes[row], sanitized_search[row])
+            if pair not in pair_positions:
+                pair_positions[pair] = len(unique_rows)
+                unique_rows.append(row)
+            fuzzy_pairs.append(pair_positions[pair])
+        self.logger.debug("Fuzzy matching %s rows as %s distinct name/code pairs", len(fuzzy_rows), len(unique_rows))
+
+        sanitized_search = sanitized_search[unique_rows]
+        sanitized_codes = sanitized_codes[unique_rows]
+        has_code = (sanitized_codes != "")[:, np.newaxis]
+
+        code_match = np.zeros((len(unique_rows), item_names.size), dtype=bool)
+        for position, search_code in enumerate(sanitized_codes.tolist()):
+            if search_code:
+                code_match[position, candidates.code_index.get(search_code, [])] = True
+
+        # Without a code match only similarities that round to 80+ count, so RapidFuzz can
+        # stop early on every other pair (scores below the cutoff come back as 0)
+        name_similarity = process.cdist(
+            sanitized_search, item_names, scorer=fuzz.ratio, dtype=np.uint8, workers=-1,
+            score_cutoff=self.NAME_SIMILARITY_CUTOFF
+        ).astype(np.int16)
+
+        # Code matches use the full similarity; there are only a few of them, so score those pairs exactly
+        match_rows, match_cols = np.nonzero(code_match)
+        if match_rows.size:
+            name_similarity[match_rows, match_cols] = process.cpdist(
+                sanitized_search[match_rows], item_names[match_cols], scorer=fuzz.ratio, dtype=np.uint8, workers=-1
+            )
+
+        # Two empty names are not similar (RapidFuzz scores them 100)
+        name_similarity[(sanitized_search == "")[:, np.newaxis] & (item_names == "")[np.newaxis, :]] = 0
+
+        # Exact matches left here are hyphen-only names matching a hyphen-only item
+        exact_match = code_match & (sanitized_search[:, np.newaxis] == item_names[np.newaxis, :])
+
+        # Case 2: Special handling for hyphen-only names with code match
+        hyphen_match = code_match & (sanitized_search == '-')[:, np.newaxis]
+
+        # Case 3: Code match with name similarity boost
+        # Case 4: High name similarity but code mismatch (penalized)
+        adjusted_similarity = np.where(
+            code_match,
+            np.minimum(100, name_similarity + 25),
+            np.where(has_code & (name_similarity >= 80), np.maximum(50, name_similarity - 15), 0)
+        )
+
+        for row, position in zip(fuzzy_rows, fuzzy_pairs):
+            direct_matches = np.flatnonzero(exact_match[position] | hyphen_match[position])
+            if direct_matches.size:
+                best = direct_matches[0]
+                results[row] = {'item': item_at(best), 'similarity': 100 if exact_match[position, best] else 95}
+                continue
 
-        best_match = None
-        best_similarity = 0
-        match_type = "none"
+            best = int(adjusted_similarity[position].argmax())
+            if adjusted_similarity[position, best] > 0:
+                results[row] = {'item': item_at(best), 'similarity': int(adjusted_similarity[position, best])}
 
-        # Special handling for hyphen-only names
-        is_hyphen_only = sanitized_search == '-'
+        return results
 
-        # Process all items once with comprehensive matching logic
-        for item_row in all_items:
-            item_dict = dict(item_row)
-            item_code = self._normalize_text(item_dict['code'])
-            item_name = self._normalize_text(item_dict['name'])
-            
-            
-            # Calculate name similarity once
-            name_similarity = fuzz.ratio(sanitized_search, item_name)
-
-            # Case 1: Exact match (code + name)
-            if sanitized_code and item_code == sanitized_code and item_name == sanitized_search:
-                self.logger.debug(f"EXACT MATCH: {item_dict['name']}")
-                return {'item': item_dict, 'similarity': 100}
-
-            # Case 2: Special handling for hyphen-only names with code match
-            if is_hyphen_only and sanitized_code and item_code == sanitized_code:
-                self.logger.debug(f"HYPHEN CODE MATCH: {item_dict['name']}")
-                return {'item': item_dict, 'similarity': 95}
-
-            # Case 3: Code match with name similarity boost
-            if sanitized_code and item_code == sanitized_code:
-                adjusted_similarity = min(100, name_similarity + 25)
-                self.logger.debug(f"CODE MATCH: {item_code} -> {adjusted_similarity:.0f}% (name: {name_similarity:.0f}%)")
-
-                if adjusted_similarity > best_similarity:
-                    best_similarity = adjusted_similarity
-                    best_match = {'item': item_dict, 'similarity': adjusted_similarity}
-                    match_type = "code_match"
-
-            # Case 4: High name similarity but code mismatch (penalized)
-            elif sanitized_code and name_similarity >= 80:
-                # Apply penalty for code mismatch but still consider it
-                adjusted_similarity = max(50, name_similarity - 15)
-                self.logger.debug(f"NAME MATCH WITH CODE MISMATCH: {name_similarity:.0f}% -> {adjusted_similarity:.0f}% (penalty applied)")
-
-                if adjusted_similarity > best_similarity:
-                    best_similarity = adjusted_similarity
-                    best_match = {'item': item_dict, 'similarity': adjusted_similarity}
-                    match_type = "name_match_code_mismatch"
-            
-            # # Case 5: Pure name matching (fallback for items without codes)
-            # elif not sanitized_code and name_similarity > best_similarity:
-            #     best_similarity = name_similarity
-            #     best_match = {'item': item_dict, 'similarity': name_similarity}
-            #     match_type = "name_only"
-
-        # Final debug log
-        if best_match:
-            self.logger.debug(f"Best match ({match_type}): {best_similarity:.0f}% - {best_match['item']['name'][:50]}...")
-        else:
-            self.logger.debug("No suitable match found")
-        
-        return best_match
     #WORK3:make nested dicts pydantic models for easy code maintenance and reading
     def process_boq_sheet(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
         """Process a BOQ sheet and return processed matches"""
@@ -214,52 +373,55 @@ class BaseSheetProcessor(ABC):
         total_rows = len(df)
         matched_count = 0
         
-        for idx, row in df.iterrows():
-            try:
-                # Extract name and code
-                name_col = self.column_mapping['name'] - 1
-                code_col = self.column_mapping['code'] - 1
-                
-                if name_col >= len(row):
-                    continue
-                
-                name = str(row.iloc[name_col]).strip()
-                code = str(row.iloc[code_col]).strip() if code_col < len(row) else ""
-                
-                # Skip empty or header rows
-                if self._should_skip_boq_row(name):
-                    continue
-                
-                # Find match
-                match = self.find_best_match(name, code)
-                
-                if match:
-                    processed_items.append({
-                        'original_row_index': idx,
-                        'row_code': code,
-                        'row_name': name,
-                        'match': match
-                    })
-                    matched_count += 1
-                    self.logger.debug(f"Match: '{name[:40]}...' -> {match['similarity']:.0f}% similarity")
-                    
-            except Exception as e:
-                self.logger.error(f"Error processing BOQ row {idx}: {e}")
-                continue
+        # Load and normalize master items once for the whole sheet
+        candidates = self.load_match_candidates()
         
-        self.logger.debug(f"Sheet {self.table_name}: {matched_count}/{total_rows} items matched")
-        return processed_items
-    
-    def _should_skip_boq_row(self, name: str) -> bool:
-        """Check if BOQ row should be skipped"""
-        clean_name = name.strip()
+        name_col = self.column_mapping['name'] - 1
+        code_col = self.column_mapping['code'] - 1
         
-        if (not clean_name or 
-            clean_name.lower() in ['nan', 'none', ''] or 
-            any(keyword in clean_name.lower() for keyword in ['total', 'รวม'])):
-            return True
+        if name_col >= df.shape[1]:
+            self.logger.debug("Sheet %s: name column %s not present", self.table_name, name_col + 1)
+            return processed_items
         
-        return False
+        # Extract name and code columns in one pass instead of row by row
+        names = df.iloc[:, name_col].map(str).str.strip()
+        if code_col < df.shape[1]:
+            codes = df.iloc[:, code_col].map(str).str.strip()
+        else:
+            codes = pd.Series('', index=df.index)
+        
+        # Skip empty or header rows
+        keep = ~self._skip_boq_row_mask(names)
+        row_indices = df.index[keep].tolist()
+        row_codes = codes[keep].tolist()
+        row_names = names[keep].tolist()
+        
+        # Find matches for all rows at once
+        matches = self.find_best_matches(row_names, row_codes, candidates)
+        
+        for idx, code, name, match in zip(row_indices, row_codes, row_names, matches):
+            if match:
+                processed_items.append({
+                    'original_row_index': idx,
+                    'row_code': code,
+                    'row_name': name,
+                    'match': match
+                })
+                matched_count += 1
+                self.logger.debug("Match: '%s...' -> %.0f%% similarity", name[:40], match['similarity'])
+        
+        self.logger.debug("Sheet %s: %s/%s items matched", self.table_name, matched_count, total_rows)
+        return processed_items
+    
+    def get_quantities(self, df: pd.DataFrame) -> List[float]:
+        """Get the quantity of every BOQ row, indexed like the rows in processed matches"""
+        quantity_col = self.column_mapping.get('quantity', 4)  # Default to column D
+        return self._numeric_column(df, quantity_col - 1).tolist()
+    
+    def _skip_boq_row_mask(self, names: pd.Series) -> pd.Series:
+        """Mark BOQ rows that should be skipped (empty, header and total rows); names arrive stripped"""
+        lowered = names.str.lower()
+        return lowered.isin(['nan', 'none', '']) | lowered.str.contains(self.BOQ_TOTAL_ROW_PATTERN)
     
     def _is_summary_sheet(self, sheet_name: str) -> bool:
         """Check if this is a summary sheet that should skip markup processing"""
@@ -285,13 +447,14 @@ class BaseSheetProcessor(ABC):
         return False
     
     #WORK4: have non interior sheet function for calculting columns such as material_total, labor_total (multiplied with qty)
-    def process_final_sheet(self, worksheet, data_worksheet, sheet_info: Dict[str, Any], markup_options: List[int], apply_markup_percent: Optional[float] = None) -> Dict[str, Any]:
+    def process_final_sheet(self, worksheet, sheet_info: Dict[str, Any], markup_options: List[int], apply_markup_percent: Optional[float] = None) -> Dict[str, Any]:
       """
       Process final sheet by applying costs to matched items and writing section totals.
       Uses pre-calculated matches and sections from sheet_info.
       """
       items_processed = 0
       items_failed = 0
+      items_zero_cost = 0
 
       try:
           # Check if this is a summary sheet - skip markup processing if so
@@ -299,7 +462,7 @@ class BaseSheetProcessor(ABC):
           is_summary_sheet = self._is_summary_sheet(sheet_name)
           
           if is_summary_sheet:
-              self.logger.debug(f"Detected summary sheet '{sheet_name}' - skipping markup processing")
+              self.logger.debug("Detected summary sheet '%s' - skipping markup processing", sheet_name)
               return {
                   'items_processed': 0,
                   'items_failed': 0,
@@ -310,36 +473,52 @@ class BaseSheetProcessor(ABC):
           # Get stored data from session
           processed_matches = sheet_info.get('processed_matches', {})
           sections = sheet_info.get('sections', {})
+          quantities = sheet_info.get('quantities', [])
 
-          self.logger.debug(f"Processing final sheet with {len(processed_matches)} matches and {len(sections)} sections")
+          self.logger.debug("Processing final sheet with %s matches and %s sections", len(processed_matches), len(sections))
 
-          # Process individual item costs
+          # Loop-invariant values, computed once per sheet
+          excel_row_offset = self.header_row + 2
+          markup_multiplier = 1 + (apply_markup_percent / 100) if apply_markup_percent is not None else None
+
+          # Calculate individual item costs into column-oriented buffers: Excel rows and their cost dicts
+          excel_rows = []
+          item_costs = []
           for row_index, match_data in processed_matches.items():
               try:
-                  # Get quantity from the worksheet
-                  quantity_col = self.column_mapping.get('quantity', 4)  # Default to column D
-                  quantity = self._get_cell_value(data_worksheet, row_index + self.header_row + 2, quantity_col)
-                  quantity = self._safe_float_conversion(quantity) or 1.0
+                  # Get quantity read with the BOQ sheet (already coerced to float by get_quantities)
+                  quantity = (quantities[row_index] if row_index < len(quantities) else 0) or 1.0
 
                   # Calculate costs using the match
                   master_item = match_data['item']
                   similarity = match_data['similarity']
                   calculated_costs = self.calculate_item_costs(master_item, quantity, similarity)
 
-                  # Apply markup if requested
-                  if apply_markup_percent is not None:
-                      markup_multiplier = 1 + (apply_markup_percent / 100)
-                      for cost_key in calculated_costs:
-                          calculated_costs[cost_key] *= markup_multiplier
+                  # "Needs checking" placeholders cannot be marked up
+                  if markup_multiplier is not None and any(isinstance(value, str) for value in calculated_costs.values()):
+                      raise TypeError("cannot apply markup to non-numeric costs")
 
-                  # Write costs to worksheet
-                  self.write_item_costs(worksheet, row_index + self.header_row + 2, calculated_costs)
                   items_processed += 1
 
+                  if self.SKIP_ZERO_COST_WRITES and calculated_costs.get('total_cost') == 0:
+                      items_zero_cost += 1
+                      continue
+
+                  excel_rows.append(row_index + excel_row_offset)
+                  item_costs.append(calculated_costs)
+
               except Exception as e:
                   self.logger.error(f"Failed to process item at row {row_index}: {e}")
                   items_failed += 1
 
+          # Apply markup to all buffered rows at once
+          if markup_multiplier is not None:
+              self._scale_item_costs(item_costs, markup_multiplier)
+
+          # Write costs to worksheet in one pass, top to bottom
+          for index in np.argsort(excel_rows, kind='stable'):
+              self.write_item_costs(worksheet, excel_rows[index], item_costs[index])
+
           # Calculate and write section totals using structure from session
           if sections:
               # Calculate totals from the now-filled worksheet
@@ -357,7 +536,7 @@ class BaseSheetProcessor(ABC):
                   # When applying markup directly, just write regular totals without markup columns
                   self.write_section_totals(worksheet, sections_with_totals, [], 0)
 
-          self.logger.debug(f"Final sheet processing complete: {items_processed} processed, {items_failed} failed")
+          self.logger.debug("Final sheet processing complete: %s processed, %s failed, %s zero-cost rows skipped", items_processed, items_failed, items_zero_cost)
 
       except Exception as e:
           self.logger.error(f"Error in process_final_sheet: {e}")
@@ -370,13 +549,6 @@ class BaseSheetProcessor(ABC):
           'sections_written': len(sections)
       }
 
-    def _get_cell_value(self, worksheet, row: int, col: int):
-        """Safely get cell value from worksheet"""
-        try:
-            return worksheet.cell(row=row, column=col).value
-        except:
-            return None
-
     def calculate_section_totals(self, worksheet, section_structure: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
         """Calculate section totals from filled worksheet using pre-determined structure"""
         for section_id, section_data in section_structure.items():
@@ -389,6 +561,38 @@ class BaseSheetProcessor(ABC):
                 section_data.update(totals)
         return section_structure
     
+    def _scale_item_costs(self, item_costs: List[Dict[str, float]], multiplier: float) -> None:
+        """Multiply every buffered cost by multiplier in place, one array pass per cost layout"""
+        layouts: Dict[tuple, List[int]] = {}
+        for index, costs in enumerate(item_costs):
+            layouts.setdefault(tuple(costs), []).append(index)
+
+        for cost_keys, indices in layouts.items():
+            values = np.array([[item_costs[i][key] for key in cost_keys] for i in indices], dtype=np.float64)
+            for i, scaled in zip(indices, (values * multiplier).tolist()):
+                item_costs[i] = dict(zip(cost_keys, scaled))
+    
+    def item_cost_columns(self) -> List[Tuple[str, int]]:
+        """Columns for ITEM_COST_TYPES, in that order; unmapped cost types are left out"""
+        if self._item_cost_columns is None:
+            column_mapping = self.column_mapping
+            self._item_cost_columns = [
+                (cost_type, column_mapping[cost_type]) for cost_type in self.ITEM_COST_TYPES if column_mapping.get(cost_type)
+            ]
+        return self._item_cost_columns
+    
+    def _write_row_values(self, worksheet, row: int, values: Dict[int, Any]) -> None:
+        """Write a buffered {column: value} row in insertion order"""
+        # Callers wrap the whole row in a single try/except; a cell covered by a merged range
+        # is read-only and raises, which ends the row's writes there
+        cell_at = worksheet.cell
+        for col, value in values.items():
+            cell_at(row=row, column=col).value = value
+    
+    def get_markup_factors(self, markup_options: List[int]) -> np.ndarray:
+        """Get the (1 + rate) multiplier for each markup option, in column order"""
+        return 1 + np.array([self.markup_rates.get(markup_percent, 1.0) for markup_percent in markup_options], dtype=np.float64)
+    
     def write_markup_headers(self, worksheet, markup_options: List[int], start_markup_col: int) -> None:
         """Write markup percentage headers at the header row"""
         try:
@@ -398,7 +602,7 @@ class BaseSheetProcessor(ABC):
                 col_num = start_markup_col + i
                 header_text = f"{markup_percent}% Markup"
                 worksheet.cell(row=header_row, column=col_num).value = header_text
-                self.logger.debug(f"Wrote markup header '{header_text}' to ({header_row}, {col_num})")
+                self.logger.debug("Wrote markup header '%s' to (%s, %s)", header_text, header_row, col_num)
         
         except Exception as e:
             self.logger.error(f"Error writing markup headers: {e}")
@@ -422,7 +626,7 @@ class BaseSheetProcessor(ABC):
     
   
     @abstractmethod
-    def write_markup_costs(self, worksheet, row: int, base_cost: float, markup_options: List[int], start_col: int) -> None:
+    def write_markup_costs(self, worksheet, row: int, markup_values: np.ndarray, start_col: int) -> None:
         """Write markup costs to worksheet"""
         pass
     @abstractmethod
@@ -434,12 +638,8 @@ class BaseSheetProcessor(ABC):
         """Sync processed data to database"""
         pass
     @abstractmethod
-    def extract_item_data(self, row: pd.Series) -> Optional[Dict[str, Any]]:
-        """Extract item data from a row using column mapping"""
-        pass
-    @abstractmethod
-    def handle_duplicate_item(self, existing_item: Dict[str, Any], new_item: Dict[str, Any]) -> None:
-        """Handle duplicate items by updating costs if new item has better data"""
+    def extract_items_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Extract item data from all rows at once using column mapping"""
         pass
     
     @abstractmethod
@@ -10,15 +10,17 @@ sys.path.append(str(Path(__file__).parent.parent.parent))
 
 from typing import Dict, Any, List, Tuple, Optional
 import pandas as pd
-import uuid
+import numpy as np
 import sqlite3
 
-from .base_sheet_processor import BaseSheetProcessor
+from .base_sheet_processor import BaseSheetProcessor, connect_database
 from models.config_models import SystemProcessorConfig
 
 class FPSheetProcessor(BaseSheetProcessor):
     """Processor for Fire Protection (FP) sheets"""
     
+    ITEM_COST_TYPES = ('material_unit_cost', 'material_cost', 'labor_unit_cost', 'labor_cost', 'total_cost')
+    
     def __init__(self, db_path: str, markup_rates: Dict[int, float], config: Optional[SystemProcessorConfig] = None):
         super().__init__(db_path, markup_rates, config)
         # Use default values if no config provided
@@ -67,6 +69,8 @@ class FPSheetProcessor(BaseSheetProcessor):
                 unit TEXT
             )
         ''')
+        # Serves code lookups and the ORDER BY code, name listing
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_code_name ON {self.table_name}(code, name)")
         conn.commit()
 
     def sync_to_database(self, df: pd.DataFrame) -> None:
@@ -74,111 +78,82 @@ class FPSheetProcessor(BaseSheetProcessor):
         if df.empty:
             return
         
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_database(self.db_path) as conn:
             # Clear existing data
             conn.execute(f"DELETE FROM {self.table_name}")
             
-            # Insert new data
-            for _, row in df.iterrows():
-                try:
-                    conn.execute(
-                        f"INSERT INTO {self.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) "
-                        f"VALUES (?, ?, ?, ?, ?, ?)",
-                        (
-                            row['internal_id'],
-                            row['code'],
-                            row['name'],
-                            row['material_unit_cost'],
-                            row['labor_unit_cost'],
-                            row.get('unit', '')
-                        )
-                    )
-                except sqlite3.IntegrityError as e:
-                    self.logger.error(f"Database integrity error: {e}")
-                    continue
+            # Insert new data in a single batched statement
+            rows = list(zip(
+                df['internal_id'],
+                df['code'],
+                df['name'],
+                df['material_unit_cost'],
+                df['labor_unit_cost'],
+                df['unit'].fillna('') if 'unit' in df.columns else [''] * len(df)
+            ))
+            cursor = conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, unit) "
+                f"VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if cursor.rowcount < len(rows):
+                self.logger.error(f"Database integrity error: skipped {len(rows) - cursor.rowcount} duplicate rows")
             
             conn.commit()
-            self.logger.debug(f"Synchronized {len(df)} items to {self.table_name}")
+            self.logger.debug("Synchronized %s items to %s", len(df), self.table_name)
+        
+        self.invalidate_match_candidates()
 
-    def extract_item_data(self, row: pd.Series) -> Optional[Dict[str, Any]]:
-        """Extract item data from a row using column mapping"""
-        try:
-            # Get values from fixed positions
-            code_idx = self.column_mapping['code'] - 1  # Convert to 0-based
-            name_idx = self.column_mapping['name'] - 1
-            material_unit_idx = self.column_mapping['material_unit_cost'] - 1
-            material_idx = self.column_mapping['material_cost'] - 1
-            labor_unit_idx = self.column_mapping['labor_unit_cost'] - 1
-            labor_idx = self.column_mapping['labor_cost'] - 1
-            unit_idx = (self.column_mapping['unit'] - 1) if 'unit' in self.column_mapping else None
-            
-            # Extract values safely
-            row_values = row.values
-            if len(row_values) <= max(code_idx, name_idx, material_unit_idx, labor_unit_idx):
-                return None
-            
-            # Extract values exactly as they appear in Excel (no cleaning)
-            code = str(row_values[code_idx]) if code_idx < len(row_values) and pd.notna(row_values[code_idx]) else ''
-            name = str(row_values[name_idx]) if name_idx < len(row_values) and pd.notna(row_values[name_idx]) else ''
-            
-            # Skip total/summary rows and completely empty rows (but don't modify data)
-            if(self._is_skip_row(code) or (not name.strip() and not code.strip())):
-                return None
-            
-            # Convert cost values only
-            material_unit_cost = self._safe_float_conversion(row_values[material_unit_idx] if material_unit_idx < len(row_values) else 0)
-            material_cost = self._safe_float_conversion(row_values[material_idx] if material_idx < len(row_values) else 0)
-            labor_unit_cost = self._safe_float_conversion(row_values[labor_unit_idx] if labor_unit_idx < len(row_values) else 0)
-            labor_cost = self._safe_float_conversion(row_values[labor_idx] if labor_idx < len(row_values) else 0)
-            unit = str(row_values[unit_idx]) if unit_idx is not None and unit_idx < len(row_values) and pd.notna(row_values[unit_idx]) else ''
-            
-            return {
-                'internal_id': f"item_{uuid.uuid4().hex[:8]}",
-                'code': code,
-                'name': name,
-                'material_unit_cost': material_unit_cost,
-                'material_cost': material_cost,
-                'labor_unit_cost': labor_unit_cost,
-                'labor_cost': labor_cost,
-                'total_cost': material_cost + labor_cost,
-                'unit': unit
-            }
-            
-        except Exception as e:
-            self.logger.error(f"Error extracting item data: {e}")
-            return None
-    def handle_duplicate_item(self, existing_item: Dict[str, Any], new_item: Dict[str, Any]) -> None:
-        """Handle duplicate items by updating costs if new item has better data"""
-        self.logger.warning(f"Duplicate item: Code='{new_item['code']}', Name='{new_item['name']}'")
+    def extract_items_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Extract item data from all rows at once using column mapping"""
+        # Get values from fixed positions
+        code_idx = self.column_mapping['code'] - 1  # Convert to 0-based
+        name_idx = self.column_mapping['name'] - 1
+        material_unit_idx = self.column_mapping['material_unit_cost'] - 1
+        material_idx = self.column_mapping['material_cost'] - 1
+        labor_unit_idx = self.column_mapping['labor_unit_cost'] - 1
+        labor_idx = self.column_mapping['labor_cost'] - 1
+        unit_idx = (self.column_mapping['unit'] - 1) if 'unit' in self.column_mapping else None
+        
+        if df.shape[1] <= max(code_idx, name_idx, material_unit_idx, labor_unit_idx):
+            return pd.DataFrame()
+        
+        # Extract values exactly as they appear in Excel (no cleaning)
+        code = self._text_column(df, code_idx)
+        name = self._text_column(df, name_idx)
+        
+        # Skip total/summary rows and completely empty rows (but don't modify data)
+        keep = ~self._skip_row_mask(code) & ((name.str.strip() != '') | (code.str.strip() != ''))
+        
+        # Convert cost values only
+        material_unit_cost = self._numeric_column(df, material_unit_idx)[keep].to_numpy()
+        material_cost = self._numeric_column(df, material_idx)[keep].to_numpy()
+        labor_unit_cost = self._numeric_column(df, labor_unit_idx)[keep].to_numpy()
+        labor_cost = self._numeric_column(df, labor_idx)[keep].to_numpy()
         
-        # Update if new item has costs and existing doesn't
-        if (new_item['material_unit_cost'] > 0 or new_item['labor_unit_cost'] > 0 or new_item['material_cost'] > 0 or new_item['labor_cost']) and \
-           (existing_item['material_unit_cost'] == 0 and existing_item['labor_unit_cost'] == 0 and existing_item['material_cost'] == 0 and existing_item['labor_cost'] == 0):
-            existing_item.update({
-                'material_unit_cost': new_item['material_unit_cost'],
-                'material_cost': new_item['material_cost'],
-                'labor_unit_cost': new_item['labor_unit_cost'],
-                'labor_cost': new_item['labor_cost'],
-                'total_cost': new_item['total_cost']
-            })
-            self.logger.debug(f"Updated costs for duplicate: Material unit={new_item['material_unit_cost']}, Material={new_item['material_cost']}, Labor unit={new_item['labor_unit_cost']}, Labor ={new_item['labor_cost']}")
+        return pd.DataFrame({
+            'internal_id': self.generate_item_ids(len(material_cost)),
+            'code': code[keep].to_numpy(),
+            'name': name[keep].to_numpy(),
+            'material_unit_cost': material_unit_cost,
+            'material_cost': material_cost,
+            'labor_unit_cost': labor_unit_cost,
+            'labor_cost': labor_cost,
+            'total_cost': material_cost + labor_cost,
+            'unit': self._text_column(df, unit_idx)[keep].to_numpy()
+        })
     
     def write_item_costs(self, worksheet, row: int, calculated_costs: Dict[str, float]) -> None:
         """Write calculated costs to worksheet row"""
         try:
-            # Map cost types to column positions
-            cost_mapping = {
-                'material_unit_cost': self.column_mapping.get('material_unit_cost'),
-                'material_cost': self.column_mapping.get('material_cost'),
-                'labor_unit_cost': self.column_mapping.get('labor_unit_cost'),
-                'labor_cost': self.column_mapping.get('labor_cost'),
-                'total_cost': self.column_mapping.get('total_cost')
+            # Buffer the row as {column: value} and write it in one pass;
+            # cost columns are resolved once per processor
+            row_values = {
+                col_num: calculated_costs[cost_type]
+                for cost_type, col_num in self.item_cost_columns()
+                if cost_type in calculated_costs
             }
-
-            # Write each cost to its column
-            for cost_type, col_num in cost_mapping.items():
-                if col_num and cost_type in calculated_costs:
-                    worksheet.cell(row=row, column=col_num).value = calculated_costs[cost_type]
+            self._write_row_values(worksheet, row, row_values)
 
         except Exception as e:
             self.logger.error(f"Error writing costs to row {row}: {e}")
@@ -230,24 +205,27 @@ class FPSheetProcessor(BaseSheetProcessor):
         name_col = self.column_mapping['name']
         total_row_col = self.column_mapping['total_row_col']
         
-        self.logger.debug(f"Scanning electrical sheet for sections in column {total_row_col} (max_row={max_row})")
+        self.logger.debug("Scanning electrical sheet for sections in column %s (max_row=%s)", total_row_col, max_row)
         
-        # Scan for total rows
-        for row_idx in range(1, max_row + 1):
-            total_cell = worksheet.cell(row=row_idx, column= total_row_col).value
-            name_cell = worksheet.cell(row=row_idx, column=name_col).value
-            
+        # Scan for total rows, remembering each one for the section lookups that follow
+        total_rows = []
+        total_column = worksheet.iter_rows(min_row=1, max_row=max_row, min_col=total_row_col, max_col=total_row_col, values_only=True)
+        for row_idx, (total_cell,) in enumerate(total_column, start=1):
             total_text = str(total_cell).strip() if total_cell else ""
-            name_text = str(name_cell).strip() if name_cell else ""
             
             # Debug every row that has content in total_row_col
             if total_text:
-                self.logger.debug(f"Row {row_idx} column {total_row_col}: '{total_text}' (checking for รวมรายการ)")
+                self.logger.debug("Row %s column %s: '%s' (checking for รวมรายการ)", row_idx, total_row_col, total_text)
             
             # Look for 'Total' in code column
-            if 'รวมรายการ' in total_text.lower() or total_text.lower() == 'รวม':
+            if self.SECTION_TOTAL_PATTERN.search(total_text):
+                # The name is only needed on total rows
+                name_cell = worksheet.cell(row=row_idx, column=name_col).value
+                name_text = str(name_cell).strip() if name_cell else ""
+                
                 # Get section info (ID and start row)
-                section_id, section_start_row = self._find_section_info(worksheet, row_idx, name_text)
+                section_id, section_start_row = self._find_section_info(worksheet, row_idx, name_text, total_rows)
+                total_rows.append(row_idx)
                 
                 sections[section_id] = {
                     'total_row': row_idx,
@@ -256,7 +234,7 @@ class FPSheetProcessor(BaseSheetProcessor):
                     'section_id': section_id
                 }
                 
-                self.logger.debug(f"Found interior section structure '{section_id}' (rows {section_start_row}-{row_idx-1})")
+                self.logger.debug("Found interior section structure '%s' (rows %s-%s)", section_id, section_start_row, row_idx - 1)
         
         # If no sections found, create a default main section
         if not sections:
@@ -269,7 +247,8 @@ class FPSheetProcessor(BaseSheetProcessor):
         
         return sections
     
-    def _find_section_info(self, worksheet, total_row: int, section_name_from_total: str) -> Tuple[str, int]:
+    def _find_section_info(self, worksheet, total_row: int, section_name_from_total: str,
+                           previous_total_rows: List[int]) -> Tuple[str, int]:
         """
         Find the section ID and start row for a total row using method 2 only:
         Find previous total row, section header = previous_total + 1
@@ -279,17 +258,16 @@ class FPSheetProcessor(BaseSheetProcessor):
         total_row_col = self.column_mapping['total_row_col']
         
         # METHOD 2: Find previous total, section header = previous_total + 1
-        for i in range(total_row - 1, max(1, total_row - 100), -1):
-            check_code_cell = worksheet.cell(row=i, column=total_row_col).value
-            check_code_text = str(check_code_cell).strip() if check_code_cell else ""
-            
-            # Found another total row using same pattern as find_section_structure
-            if 'รวมรายการ' in check_code_text.lower() or check_code_text.lower() == 'รวม':
-                section_header_row = i + 1
-                code_cell = worksheet.cell(row=section_header_row, column=total_row_col).value
-                section_code = str(code_cell).strip() if code_cell else ""
-                if section_code:
-                    return section_code, section_header_row + 1  # (section_id, start_row after header)
+        # Earlier total rows come from the top-down scan, so walk them nearest first
+        # instead of rereading the total column upward (same 100-row window)
+        for i in reversed(previous_total_rows):
+            if i <= max(1, total_row - 100):
+                break
+            section_header_row = i + 1
+            code_cell = worksheet.cell(row=section_header_row, column=total_row_col).value
+            section_code = str(code_cell).strip() if code_cell else ""
+            if section_code:
+                return section_code, section_header_row + 1  # (section_id, start_row after header)
         
         # FALLBACK: For first section, start from header row + 1
         # If no previous total found, this is likely the first section
@@ -309,14 +287,15 @@ class FPSheetProcessor(BaseSheetProcessor):
         item_count = 0
         
         # Get column positions
-        mat_unit_col = self.column_mapping['material_unit_cost']
-        mat_col = self.column_mapping['material_cost']
-        lab_unit_col = self.column_mapping['labor_unit_cost']
-        lab_col = self.column_mapping['labor_cost']
-        total_col = self.column_mapping['total_cost']
-        total_row_col = self.column_mapping['total_row_col']
+        column_mapping = self.column_mapping
+        mat_unit_col = column_mapping['material_unit_cost']
+        mat_col = column_mapping['material_cost']
+        lab_unit_col = column_mapping['labor_unit_cost']
+        lab_col = column_mapping['labor_cost']
+        total_col = column_mapping['total_cost']
+        total_row_col = column_mapping['total_row_col']
         
-        self.logger.debug(f"Calculating totals for range {start_row}-{end_row}")
+        self.logger.debug("Calculating totals for range %s-%s", start_row, end_row)
         
         # Sum up all items in the section range
         for row in range(start_row, end_row + 1):
@@ -325,7 +304,7 @@ class FPSheetProcessor(BaseSheetProcessor):
             total_row_text = str(total_row_cell).strip() if total_row_cell else ""
             
             # Skip only actual total rows, not empty code cells - use same pattern as find_section_structure
-            if 'รวมรายการ' in total_row_text.lower() or total_row_text.lower() == 'รวม':
+            if self.SECTION_TOTAL_PATTERN.search(total_row_text):
                 continue
             
             # Get costs from each row
@@ -352,7 +331,8 @@ class FPSheetProcessor(BaseSheetProcessor):
                 total_cost_sum += total_cost
                 item_count += 1
                 
-                self.logger.debug(f"Row {row} ({total_row_text}): Mat unit={mat_unit_cost}, Lab unit={lab_unit_cost}, Mat={mat_cost}, Lab={lab_cost}, Total={total_cost}")
+                self.logger.debug("Row %s (%s): Mat unit=%s, Lab unit=%s, Mat=%s, Lab=%s, Total=%s",
+                                  row, total_row_text, mat_unit_cost, lab_unit_cost, mat_cost, lab_cost, total_cost)
         
         return {
             'material_unit_sum': material_unit_cost_sum,
@@ -365,6 +345,9 @@ class FPSheetProcessor(BaseSheetProcessor):
     
     def _safe_float(self, value) -> float:
         """Safely convert value to float"""
+        # Numbers are the common case; only text needs the checks and the try
+        if isinstance(value, (int, float)):
+            return float(value)
         try:
             if value is None or value == '' or value == '-':
                 return 0.0
@@ -378,15 +361,30 @@ class FPSheetProcessor(BaseSheetProcessor):
         Write pre-calculated section totals to worksheet.
         Totals are already calculated in find_section_boundaries using range-based approach.
         """
-        self.logger.debug(f"write_section_totals called with {len(sections)} sections: {list(sections.keys())}")
+        self.logger.debug("write_section_totals called with %s sections: %s", len(sections), list(sections.keys()))
+        
+        # Look up the markup rates once for every total row on the sheet
+        markup_factors = self.get_markup_factors(markup_options)
+        
+        # Total columns are the same for every section
+        column_mapping = self.column_mapping
+        mat_unit_col = column_mapping['material_unit_cost']
+        mat_col = column_mapping['material_cost']
+        lab_unit_col = column_mapping['labor_unit_cost']
+        lab_col = column_mapping['labor_cost']
+        total_col = column_mapping['total_cost']
         
-        for section_id, section_data in sections.items():
+        # Markups for every section total in one pass: one row of markup values per section
+        section_totals = np.array([section_data.get('total_sum', 0) for section_data in sections.values()], dtype=np.float64)
+        section_markups = np.multiply.outer(section_totals, markup_factors)
+        
+        for section_markup, (section_id, section_data) in zip(section_markups, sections.items()):
             total_row = section_data.get('total_row')
             if not total_row:
                 continue
             
-            self.logger.debug(f"Writing pre-calculated totals for '{section_id}' at row {total_row}")
-            self.logger.debug(f"Section data keys: {list(section_data.keys())}")
+            self.logger.debug("Writing pre-calculated totals for '%s' at row %s", section_id, total_row)
+            self.logger.debug("Section data keys: %s", list(section_data.keys()))
             
             # Get pre-calculated sums
             material_unit_sum = section_data.get('material_unit_sum', 0)
@@ -397,50 +395,45 @@ class FPSheetProcessor(BaseSheetProcessor):
             item_count = section_data.get('item_count', 0)
 
              
-            self.logger.debug(f"Section '{section_id}': {item_count} items, "
-                           f"Material unit={material_unit_sum}, Labor unit={labor_unit_sum}, Material={material_sum}, Labor={labor_sum}, Total sum={total_sum}")
-            
-            # Write basic totals
-            mat_unit_col = self.column_mapping['material_unit_cost']
-            mat_col = self.column_mapping['material_cost']
-            lab_unit_col = self.column_mapping['labor_unit_cost']
-            lab_col = self.column_mapping['labor_cost']
-            total_col = self.column_mapping['total_cost']
+            self.logger.debug("Section '%s': %s items, "
+                              "Material unit=%s, Labor unit=%s, Material=%s, Labor=%s, Total sum=%s",
+                              section_id, item_count, material_unit_sum, labor_unit_sum, material_sum, labor_sum, total_sum)
             
             try:
-                self.logger.debug(f"Writing to cells: mat_unit=({total_row},{mat_unit_col}), mat=({total_row},{mat_col}), lab_unit=({total_row},{lab_unit_col}), lab=({total_row},{lab_col}), total=({total_row},{total_col})")
+                self.logger.debug("Writing to cells: mat_unit=(%s,%s), mat=(%s,%s), lab_unit=(%s,%s), lab=(%s,%s), total=(%s,%s)", total_row, mat_unit_col, total_row, mat_col, total_row, lab_unit_col, total_row, lab_col, total_row, total_col)
                 
-                worksheet.cell(row=total_row, column=mat_unit_col).value = material_unit_sum
-                worksheet.cell(row=total_row, column=mat_col).value = material_sum
-                worksheet.cell(row=total_row, column=lab_unit_col).value = labor_unit_sum
-                worksheet.cell(row=total_row, column=lab_col).value = labor_sum
-                worksheet.cell(row=total_row, column=total_col).value = total_sum
+                self._write_row_values(worksheet, total_row, {
+                    mat_unit_col: material_unit_sum,
+                    mat_col: material_sum,
+                    lab_unit_col: labor_unit_sum,
+                    lab_col: labor_sum,
+                    total_col: total_sum
+                })
                 
-                self.logger.debug(f"Cell values written: mat_unit={material_unit_sum}, mat={material_sum}, lab_unit={labor_unit_sum}, lab={labor_sum}, total={total_sum}")
+                self.logger.debug("Cell values written: mat_unit=%s, mat=%s, lab_unit=%s, lab=%s, total=%s", material_unit_sum, material_sum, labor_unit_sum, labor_sum, total_sum)
                 
                 # Write markup totals
-                self.write_markup_costs(worksheet, total_row, total_sum, 
-                                      markup_options, start_markup_col)
+                self.write_markup_costs(worksheet, total_row, section_markup, start_markup_col)
                 
-                self.logger.debug(f"Section '{section_id}' totals written successfully")
+                self.logger.debug("Section '%s' totals written successfully", section_id)
                 
             except Exception as e:
                 self.logger.error(f"Error writing section totals for '{section_id}': {e}")
                 import traceback
                 self.logger.error(traceback.format_exc())
     
-    def write_markup_costs(self, worksheet, row: int, base_cost: float, markup_options: List[int], start_col: int) -> None:
+    def write_markup_costs(self, worksheet, row: int, markup_values: np.ndarray, start_col: int) -> None:
         """Write markup costs for interior items"""
-        for i, markup_percent in enumerate(markup_options):
-            markup_rate = self.markup_rates.get(markup_percent, 1.0)
-            markup_cost = round(base_cost * (1 + markup_rate), 2)
-            col_num = start_col + i
-            
-            try:
+        # Markups arrive precomputed for the whole row; round and write them to consecutive columns
+        markup_costs = [round(markup_cost, 2) for markup_cost in markup_values.tolist()]
+        
+        try:
+            # Markup columns are appended after the template columns, so they are never merged
+            for col_num, markup_cost in enumerate(markup_costs, start=start_col):
                 worksheet.cell(row=row, column=col_num).value = markup_cost
-                self.logger.debug(f"Wrote markup {markup_percent}% = {markup_cost} to ({row}, {col_num})")
-            except Exception as e:
-                self.logger.error(f"Error writing markup to ({row}, {col_num}): {e}")
+            self.logger.debug("Wrote markups %s to row %s from column %s", markup_costs, row, start_col)
+        except Exception as e:
+            self.logger.error(f"Error writing markups to row {row}: {e}")
     
     
     
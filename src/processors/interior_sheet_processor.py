@@ -6,12 +6,12 @@ These sheets typically have a simpler structure with material and labor costs.
 
 from typing import Dict, Any, List, Tuple, Optional
 import pandas as pd
-import uuid
+import numpy as np
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent.parent))
 
-from .base_sheet_processor import BaseSheetProcessor
+from .base_sheet_processor import BaseSheetProcessor, connect_database
 import sqlite3
 from models.config_models import InteriorProcessorConfig
 
@@ -19,6 +19,8 @@ from models.config_models import InteriorProcessorConfig
 class InteriorSheetProcessor(BaseSheetProcessor):
     """Processor for Interior (INT) sheets"""
     
+    ITEM_COST_TYPES = ('material_unit_cost', 'labor_unit_cost', 'total_unit_cost', 'total_cost')
+    
     def __init__(self, db_path: str, markup_rates: Dict[int, float], config: Optional[InteriorProcessorConfig] = None):
         super().__init__(db_path, markup_rates, config)
         # Use default values if no config provided
@@ -67,6 +69,8 @@ class InteriorSheetProcessor(BaseSheetProcessor):
                 unit TEXT
             )
         ''')
+        # Serves code lookups and the ORDER BY code, name listing
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_code_name ON {self.table_name}(code, name)")
         conn.commit()
 
     def sync_to_database(self, df: pd.DataFrame) -> None:
@@ -74,103 +78,77 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         if df.empty:
             return
         
-        with sqlite3.connect(self.db_path) as conn:
+        with connect_database(self.db_path) as conn:
             # Clear existing data
             conn.execute(f"DELETE FROM {self.table_name}")
             
-            # Insert new data
-            for _, row in df.iterrows():
-                try:
-                    conn.execute(
-                        f"INSERT INTO {self.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) "
-                        f"VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            row['internal_id'],
-                            row['code'],
-                            row['name'],
-                            row['material_unit_cost'],
-                            row['labor_unit_cost'],
-                            row['total_unit_cost'],
-                            row.get('unit', '')
-                        )
-                    )
-                except sqlite3.IntegrityError as e:
-                    self.logger.error(f"Database integrity error: {e}")
-                    continue
+            # Insert new data in a single batched statement
+            rows = list(zip(
+                df['internal_id'],
+                df['code'],
+                df['name'],
+                df['material_unit_cost'],
+                df['labor_unit_cost'],
+                df['total_unit_cost'],
+                df['unit'].fillna('') if 'unit' in df.columns else [''] * len(df)
+            ))
+            cursor = conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table_name} (internal_id, code, name, material_unit_cost, labor_unit_cost, total_unit_cost, unit) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if cursor.rowcount < len(rows):
+                self.logger.error(f"Database integrity error: skipped {len(rows) - cursor.rowcount} duplicate rows")
             
             conn.commit()
-            self.logger.debug(f"Synchronized {len(df)} items to {self.table_name}")
+            self.logger.debug("Synchronized %s items to %s", len(df), self.table_name)
+        
+        self.invalidate_match_candidates()
 
-    def extract_item_data(self, row: pd.Series) -> Optional[Dict[str, Any]]:
-        """Extract item data from a row using column mapping"""
-        try:
-            # Get values from fixed positions
-            code_idx = self.column_mapping['code'] - 1  # Convert to 0-based
-            name_idx = self.column_mapping['name'] - 1
-            material_idx = self.column_mapping['material_unit_cost'] - 1
-            labor_idx = self.column_mapping['labor_unit_cost'] - 1
-            unit_idx = (self.column_mapping['unit'] - 1) if 'unit' in self.column_mapping else None
-            
-            # Extract values safely
-            row_values = row.values
-            if len(row_values) <= max(code_idx, name_idx, material_idx, labor_idx):
-                return None
-            
-            # Extract values exactly as they appear in Excel (no cleaning)
-            code = str(row_values[code_idx]) if code_idx < len(row_values) and pd.notna(row_values[code_idx]) else ''
-            name = str(row_values[name_idx]) if name_idx < len(row_values) and pd.notna(row_values[name_idx]) else ''
-            
-            # Skip total/summary rows and completely empty rows (but don't modify data)
-            if(self._is_skip_row(code) or (not name.strip() and not code.strip())):
-                return None
-            
-            # Convert cost values only
-            material_cost = self._safe_float_conversion(row_values[material_idx] if material_idx < len(row_values) else 0)
-            labor_cost = self._safe_float_conversion(row_values[labor_idx] if labor_idx < len(row_values) else 0)
-            unit = str(row_values[unit_idx]) if unit_idx is not None and unit_idx < len(row_values) and pd.notna(row_values[unit_idx]) else ''
-            
-            return {
-                'internal_id': f"item_{uuid.uuid4().hex[:8]}",
-                'code': code,
-                'name': name,
-                'material_unit_cost': material_cost,
-                'labor_unit_cost': labor_cost,
-                'total_unit_cost': material_cost + labor_cost,
-                'unit': unit
-            }
-            
-        except Exception as e:
-            self.logger.error(f"Error extracting item data: {e}")
-            return None
-    def handle_duplicate_item(self, existing_item: Dict[str, Any], new_item: Dict[str, Any]) -> None:
-        """Handle duplicate items by updating costs if new item has better data"""
-        self.logger.warning(f"Duplicate item: Code='{new_item['code']}', Name='{new_item['name']}'")
+    def extract_items_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Extract item data from all rows at once using column mapping"""
+        # Get values from fixed positions
+        code_idx = self.column_mapping['code'] - 1  # Convert to 0-based
+        name_idx = self.column_mapping['name'] - 1
+        material_idx = self.column_mapping['material_unit_cost'] - 1
+        labor_idx = self.column_mapping['labor_unit_cost'] - 1
+        unit_idx = (self.column_mapping['unit'] - 1) if 'unit' in self.column_mapping else None
+        
+        if df.shape[1] <= max(code_idx, name_idx, material_idx, labor_idx):
+            return pd.DataFrame()
+        
+        # Extract values exactly as they appear in Excel (no cleaning)
+        code = self._text_column(df, code_idx)
+        name = self._text_column(df, name_idx)
+        
+        # Skip total/summary rows and completely empty rows (but don't modify data)
+        keep = ~self._skip_row_mask(code) & ((name.str.strip() != '') | (code.str.strip() != ''))
+        
+        # Convert cost values only
+        material_cost = self._numeric_column(df, material_idx)[keep].to_numpy()
+        labor_cost = self._numeric_column(df, labor_idx)[keep].to_numpy()
         
-        # Update if new item has costs and existing doesn't
-        if (new_item['material_unit_cost'] > 0 or new_item['labor_unit_cost'] > 0) and \
-           (existing_item['material_unit_cost'] == 0 and existing_item['labor_unit_cost'] == 0):
-            existing_item.update({
-                'material_unit_cost': new_item['material_unit_cost'],
-                'labor_unit_cost': new_item['labor_unit_cost'],
-                'total_unit_cost': new_item['total_unit_cost']
-            })
-            self.logger.debug(f"Updated costs for duplicate: Material={new_item['material_unit_cost']}, Labor={new_item['labor_unit_cost']}")
+        return pd.DataFrame({
+            'internal_id': self.generate_item_ids(len(material_cost)),
+            'code': code[keep].to_numpy(),
+            'name': name[keep].to_numpy(),
+            'material_unit_cost': material_cost,
+            'labor_unit_cost': labor_cost,
+            'total_unit_cost': material_cost + labor_cost,
+            'unit': self._text_column(df, unit_idx)[keep].to_numpy()
+        })
     
     def write_item_costs(self, worksheet, row: int, calculated_costs: Dict[str, float]) -> None:
         """Write calculated costs to worksheet row"""
         try:
-            # Map cost types to column positions
-            cost_mapping = {
-                'material_unit_cost': self.column_mapping.get('material_unit_cost'),
-                'labor_unit_cost': self.column_mapping.get('labor_unit_cost'),
-                'total_unit_cost': self.column_mapping.get('total_unit_cost'),
-                'total_cost': self.column_mapping.get('total_cost')
+            # Buffer the row as {column: value} and write it in one pass;
+            # cost columns are resolved once per processor
+            row_values = {
+                col_num: calculated_costs[cost_type]
+                for cost_type, col_num in self.item_cost_columns()
+                if cost_type in calculated_costs
             }
-
-            # Write each cost to its column
-            for cost_type, col_num in cost_mapping.items():
-                if col_num and cost_type in calculated_costs:
-                    worksheet.cell(row=row, column=col_num).value = calculated_costs[cost_type]
+            self._write_row_values(worksheet, row, row_values)
 
         except Exception as e:
             self.logger.error(f"Error writing costs to row {row}: {e}")
@@ -224,18 +202,21 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         name_col = self.column_mapping['name']
         code_col = self.column_mapping['code']
         
-        # Scan for total rows
-        for row_idx in range(1, max_row + 1):
-            code_cell = worksheet.cell(row=row_idx, column=code_col).value
-            name_cell = worksheet.cell(row=row_idx, column=name_col).value
-            
+        # Scan for total rows, remembering each one for the section lookups that follow
+        total_rows = []
+        code_column = worksheet.iter_rows(min_row=1, max_row=max_row, min_col=code_col, max_col=code_col, values_only=True)
+        for row_idx, (code_cell,) in enumerate(code_column, start=1):
             code_text = str(code_cell).strip() if code_cell else ""
-            name_text = str(name_cell).strip() if name_cell else ""
             
             # Look for 'Total' in code column
             if code_text.lower() == 'total':
+                # The name is only needed on total rows
+                name_cell = worksheet.cell(row=row_idx, column=name_col).value
+                name_text = str(name_cell).strip() if name_cell else ""
+                
                 # Get section info (ID and start row)
-                section_id, section_start_row = self._find_section_info(worksheet, row_idx, name_text)
+                section_id, section_start_row = self._find_section_info(worksheet, row_idx, name_text, total_rows)
+                total_rows.append(row_idx)
                 
                 sections[section_id] = {
                     'total_row': row_idx,
@@ -244,7 +225,7 @@ class InteriorSheetProcessor(BaseSheetProcessor):
                     'section_id': section_id
                 }
                 
-                self.logger.debug(f"Found interior section structure '{section_id}' (rows {section_start_row}-{row_idx-1})")
+                self.logger.debug("Found interior section structure '%s' (rows %s-%s)", section_id, section_start_row, row_idx - 1)
         
         # If no sections found, create a default main section
         if not sections:
@@ -257,7 +238,8 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         
         return sections
     
-    def _find_section_info(self, worksheet, total_row: int, section_name_from_total: str) -> Tuple[str, int]:
+    def _find_section_info(self, worksheet, total_row: int, section_name_from_total: str,
+                           previous_total_rows: List[int]) -> Tuple[str, int]:
         """
         Find the section ID and start row for a total row using two methods:
         1. Search upward for code that matches the section name from total row
@@ -279,17 +261,16 @@ class InteriorSheetProcessor(BaseSheetProcessor):
                     return section_name_from_total, i + 1  # (section_id, start_row after header)
         
         # METHOD 2: Find previous total, section header = previous_total + 1
-        for i in range(total_row - 1, max(1, total_row - 100), -1):
-            check_code_cell = worksheet.cell(row=i, column=code_col).value
-            check_code_text = str(check_code_cell).strip() if check_code_cell else ""
-            
-            # Found another total row
-            if check_code_text.lower() == 'total':
-                section_header_row = i + 1
-                code_cell = worksheet.cell(row=section_header_row, column=code_col).value
-                section_code = str(code_cell).strip() if code_cell else ""
-                if section_code:
-                    return section_code, section_header_row + 1  # (section_id, start_row after header)
+        # Earlier total rows come from the top-down scan, so walk them nearest first
+        # instead of rereading the code column upward (same 100-row window)
+        for i in reversed(previous_total_rows):
+            if i <= max(1, total_row - 100):
+                break
+            section_header_row = i + 1
+            code_cell = worksheet.cell(row=section_header_row, column=code_col).value
+            section_code = str(code_cell).strip() if code_cell else ""
+            if section_code:
+                return section_code, section_header_row + 1  # (section_id, start_row after header)
         
         # FALLBACK: For first section, start from header row + 1
         # If no previous total found, this is likely the first section
@@ -308,13 +289,14 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         item_count = 0
         
         # Get column positions
-        mat_unit_col = self.column_mapping['material_unit_cost']
-        lab_unit_col = self.column_mapping['labor_unit_cost']
-        total_unit_col = self.column_mapping['total_unit_cost']
-        total_col = self.column_mapping['total_cost']
-        code_col = self.column_mapping['code']
+        column_mapping = self.column_mapping
+        mat_unit_col = column_mapping['material_unit_cost']
+        lab_unit_col = column_mapping['labor_unit_cost']
+        total_unit_col = column_mapping['total_unit_cost']
+        total_col = column_mapping['total_cost']
+        code_col = column_mapping['code']
         
-        self.logger.debug(f"Calculating totals for range {start_row}-{end_row}")
+        self.logger.debug("Calculating totals for range %s-%s", start_row, end_row)
         
         # Sum up all items in the section range
         for row in range(start_row, end_row + 1):
@@ -347,7 +329,8 @@ class InteriorSheetProcessor(BaseSheetProcessor):
                 total_cost_sum += total_cost
                 item_count += 1
                 
-                self.logger.debug(f"Row {row} ({code_text}): Mat unit={mat_unit_cost}, Lab uit={lab_unit_cost}, Total unit={total_unit_cost}, Total={total_cost}")
+                self.logger.debug("Row %s (%s): Mat unit=%s, Lab uit=%s, Total unit=%s, Total=%s",
+                                  row, code_text, mat_unit_cost, lab_unit_cost, total_unit_cost, total_cost)
         
         return {
             'material_unit_sum': material_unit_cost_sum,
@@ -359,6 +342,9 @@ class InteriorSheetProcessor(BaseSheetProcessor):
     
     def _safe_float(self, value) -> float:
         """Safely convert value to float"""
+        # Numbers are the common case; only text needs the checks and the try
+        if isinstance(value, (int, float)):
+            return float(value)
         try:
             if value is None or value == '' or value == '-':
                 return 0.0
@@ -371,14 +357,28 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         """
         Write pre-calculated section totals to worksheet.
         """
-        self.logger.debug(f"write_section_totals called with {len(sections)} sections: {list(sections.keys())}")
+        self.logger.debug("write_section_totals called with %s sections: %s", len(sections), list(sections.keys()))
+        
+        # Look up the markup rates once for every total row on the sheet
+        markup_factors = self.get_markup_factors(markup_options)
+        
+        # Total columns are the same for every section
+        column_mapping = self.column_mapping
+        mat_unit_col = column_mapping['material_unit_cost']
+        lab_unit_col = column_mapping['labor_unit_cost']
+        total_unit_col = column_mapping['total_unit_cost']
+        total_col = column_mapping['total_cost']
         
-        for section_id, section_data in sections.items():
+        # Markups for every section total in one pass: one row of markup values per section
+        section_totals = np.array([section_data.get('total_sum', 0) for section_data in sections.values()], dtype=np.float64)
+        section_markups = np.multiply.outer(section_totals, markup_factors)
+        
+        for section_markup, (section_id, section_data) in zip(section_markups, sections.items()):
             total_row = section_data.get('total_row')
             if not total_row:
                 continue
             
-            self.logger.debug(f"Writing pre-calculated totals for '{section_id}' at row {total_row}")
+            self.logger.debug("Writing pre-calculated totals for '%s' at row %s", section_id, total_row)
             
             # Get pre-calculated sums
             material_unit_sum = section_data['material_unit_sum']
@@ -386,32 +386,27 @@ class InteriorSheetProcessor(BaseSheetProcessor):
             total_unit_sum = section_data['total_unit_sum']
             total_sum = section_data["total_sum"]
             
-            # Write basic totals
-            mat_unit_col = self.column_mapping['material_unit_cost']
-            lab_unit_col = self.column_mapping['labor_unit_cost']
-            total_unit_col = self.column_mapping['total_unit_cost']
-            total_col = self.column_mapping['total_cost']
-            
             try:
-                worksheet.cell(row=total_row, column=mat_unit_col).value = material_unit_sum
-                worksheet.cell(row=total_row, column=lab_unit_col).value = labor_unit_sum
-                worksheet.cell(row=total_row, column=total_unit_col).value = total_unit_sum
-                worksheet.cell(row=total_row, column=total_col).value = total_sum
+                self._write_row_values(worksheet, total_row, {
+                    mat_unit_col: material_unit_sum,
+                    lab_unit_col: labor_unit_sum,
+                    total_unit_col: total_unit_sum,
+                    total_col: total_sum
+                })
                 
                 # Write markup totals
-                self.write_markup_costs(worksheet, total_row, total_sum, 
-                                      markup_options, start_markup_col)
+                self.write_markup_costs(worksheet, total_row, section_markup, start_markup_col)
                 
-                self.logger.debug(f"Section '{section_id}' totals written successfully")
+                self.logger.debug("Section '%s' totals written successfully", section_id)
                 
             except Exception as e:
                 self.logger.error(f"Error writing section totals for '{section_id}': {e}")
         
         # After all section totals are written, calculate and write grand total
-        self.write_grand_total_from_sections(worksheet, sections, markup_options, start_markup_col)
+        self.write_grand_total_from_sections(worksheet, sections, markup_factors, start_markup_col)
     
     def write_grand_total_from_sections(self, worksheet, sections: Dict[str, Dict[str, Any]], 
-                                      markup_options: List[int], start_markup_col: int) -> None:
+                                      markup_factors: np.ndarray, start_markup_col: int) -> None:
         """
         Calculate grand total by reading total_cost values from section rows and write to รวมรายการ row.
         """
@@ -426,26 +421,26 @@ class InteriorSheetProcessor(BaseSheetProcessor):
                     # Read the total_cost value that we just wrote
                     section_total = worksheet.cell(row=total_row, column=total_col).value or 0
                     grand_total_cost += float(section_total)
-                    self.logger.debug(f"Section '{section_id}' total: {section_total}, Grand total so far: {grand_total_cost}")
+                    self.logger.debug("Section '%s' total: %s, Grand total so far: %s", section_id, section_total, grand_total_cost)
             
             # Find รวมรายการ row in column L (8)
             search_col = 8  # Column L
             max_row = worksheet.max_row
             
-            self.logger.debug(f"Searching for รวมรายการ in column {search_col} (Column L), grand total to write: {grand_total_cost}")
+            self.logger.debug("Searching for รวมรายการ in column %s (Column L), grand total to write: %s", search_col, grand_total_cost)
             
             for row_idx in range(1, max_row + 1):
                 cell_value = worksheet.cell(row=row_idx, column=search_col).value
                 if cell_value and 'รวมรายการ' in str(cell_value):
-                    self.logger.debug(f"Found grand total row at {row_idx}: '{cell_value}'")
+                    self.logger.debug("Found grand total row at %s: '%s'", row_idx, cell_value)
                     
                     # Write only the grand total to total_cost column (I)
                     worksheet.cell(row=row_idx, column=total_col).value = grand_total_cost
                     
                     # Write markup costs for grand total
-                    self.write_markup_costs(worksheet, row_idx, grand_total_cost, markup_options, start_markup_col)
+                    self.write_markup_costs(worksheet, row_idx, grand_total_cost * markup_factors, start_markup_col)
                     
-                    self.logger.debug(f"Grand total written: {grand_total_cost} to row {row_idx}, column {total_col}")
+                    self.logger.debug("Grand total written: %s to row %s, column %s", grand_total_cost, row_idx, total_col)
                     return
             
             self.logger.debug("No grand total row found with รวมรายการ pattern")
@@ -453,18 +448,18 @@ class InteriorSheetProcessor(BaseSheetProcessor):
         except Exception as e:
             self.logger.error(f"Error writing grand total: {e}")
     
-    def write_markup_costs(self, worksheet, row: int, base_cost: float, markup_options: List[int], start_col: int) -> None:
+    def write_markup_costs(self, worksheet, row: int, markup_values: np.ndarray, start_col: int) -> None:
         """Write markup costs for interior items"""
-        for i, markup_percent in enumerate(markup_options):
-            markup_rate = self.markup_rates.get(markup_percent, 1.0)
-            markup_cost = round(base_cost * (1 + markup_rate), 2)
-            col_num = start_col + i
-            
-            try:
+        # Markups arrive precomputed for the whole row; round and write them to consecutive columns
+        markup_costs = [round(markup_cost, 2) for markup_cost in markup_values.tolist()]
+        
+        try:
+            # Markup columns are appended after the template columns, so they are never merged
+            for col_num, markup_cost in enumerate(markup_costs, start=start_col):
                 worksheet.cell(row=row, column=col_num).value = markup_cost
-                self.logger.debug(f"Wrote markup {markup_percent}% = {markup_cost} to ({row}, {col_num})")
-            except Exception as e:
-                self.logger.error(f"Error writing markup to ({row}, {col_num}): {e}")
+            self.logger.debug("Wrote markups %s to row %s from column %s", markup_costs, row, start_col)
+        except Exception as e:
+            self.logger.error(f"Error writing markups to row {row}: {e}")
     
     
     
@@ -0,0 +1,42 @@
+import re
+import zipfile
+
+import openpyxl
+
+from src.processors.base_sheet_processor import WorksheetValues
+
+
+def _write_workbook_with_bad_dimension(path, rows: int) -> None:
+    """Save a one-sheet workbook whose <dimension> tag only claims cell A1"""
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    for row in range(1, rows + 1):
+        worksheet.cell(row=row, column=1, value=f"item {row}")
+        worksheet.cell(row=row, column=3, value=row)
+    workbook.save(path)
+    
+    with zipfile.ZipFile(path) as source:
+        contents = {name: source.read(name) for name in source.namelist()}
+    sheet_xml = contents['xl/worksheets/sheet1.xml'].decode('utf-8')
+    contents['xl/worksheets/sheet1.xml'] = re.sub(r'<dimension ref="[^"]*"\s*/>', '<dimension ref="A1"/>',
+                                                  sheet_xml).encode('utf-8')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for name, data in contents.items():
+            target.writestr(name, data)
+
+
+def test_snapshot_ignores_wrong_dimension_tag(tmp_path):
+    path = tmp_path / 'bad_dimension.xlsx'
+    _write_workbook_with_bad_dimension(path, rows=29)
+    
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        assert workbook.active.max_row == 1
+        sheet_values = WorksheetValues(workbook.active)
+    finally:
+        workbook.close()
+    
+    assert sheet_values.max_row == 29
+    assert sheet_values.cell(row=29, column=1).value == 'item 29'
+    assert sheet_values.cell(row=29, column=3).value == 29
+    assert list(sheet_values.iter_rows(min_row=29, max_col=3)) == [('item 29', None, 29)]